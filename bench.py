@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+"""Benchmark tagdoc and checker on synthetic AOSP trees.
+
+A synthetic tree has a ``.repo/manifests/default.xml`` and a number of small
+git projects, each with a develop branch, a logging branch, an experiment
+branch and a checked out release branch, laid out the way :mod:`tagdoc` and
+:mod:`checker` expect. Source files carry ``PhoneLab`` tag docs at a
+configurable density, and a configurable share of projects has an experiment
+change that conflicts with the logging branch.
+
+For each tree size, stages are timed a few times and the results are saved as
+JSON, so that runs of different versions can be compared (see
+``--baseline``).
+
+.. argparse::
+  :module: platform_tools.bench
+  :func: arg_parser
+  :prog: python bench.py
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import checker
+import tagdoc
+import utils
+from utils import logger
+
+
+DEFAULT_SIZES = [10, 50, 200]
+"""Numbers of projects of the benchmarked trees."""
+
+DEFAULT_FILES = 20
+"""Source files per project."""
+
+DEFAULT_DENSITY = 0.5
+"""Average number of tag docs per source file."""
+
+DEFAULT_CONFLICTS = 0.1
+"""Share of projects where the experiment conflicts with logging."""
+
+DEFAULT_REPEAT = 3
+
+DEFAULT_OUT = os.path.join(os.getcwd(), 'bench.json')
+
+BENCH_EXPERIMENT = 'bench'
+"""Experiment code name of the synthetic experiment branch."""
+
+SOURCE_EXTS = ['.c', '.cpp', '.java']
+
+TAG_DOC = '''/* PhoneLab
+ * {
+ *   "Category": "%(category)s",
+ *   "SubCategory": "%(sub)s",
+ *   "Tag": "%(tag)s-buffalo",
+ *   "Action": "%(action)s",
+ *   "Description": "Synthetic tag doc %(n)d."
+ * }
+ */
+'''
+
+CODE = '''int func_%(n)d(int x) {
+    // Not a tag doc: "PhoneLab { }" in a string.
+    return x * %(n)d;
+}
+'''
+
+
+def git(cwd, *args):
+    utils.run(['git'] + list(args), cwd=cwd).check()
+
+
+def write_source(path, docs, rand):
+    """Write a synthetic source file with ``docs`` tag docs."""
+    with open(path, 'w') as f:
+        f.write('/* Synthetic source. */\n')
+        for n in range(max(docs, 1) * 3):
+            if n % 3 == 0 and n // 3 < docs:
+                f.write(TAG_DOC % {
+                    'category': 'Cat%d' % (rand.randint(0, 9)),
+                    'sub': 'Sub%d' % (rand.randint(0, 3)),
+                    'tag': 'Tag%d' % (rand.randint(0, 99)),
+                    'action': 'act%d' % (rand.randint(0, 999)),
+                    'n': n})
+            f.write(CODE % {'n': n})
+
+
+def generate_project(root, path, args, rand, conflict):
+    """Create one synthetic project with all the branches of a check.
+
+    Args:
+        root (str): tree root.
+        path (str): project path relative to ``root``.
+        args: parsed command line arguments.
+        rand (random.Random): random source.
+        conflict (bool): make the experiment conflict with logging.
+    """
+    d = os.path.join(root, path)
+    os.makedirs(d)
+    develop = 'phonelab/%s/develop' % (args.aosp)
+    remote_prefix = 'refs/remotes/%s/' % (checker.DEFAULT_REMOTE)
+    base = checker.DEFAULT_ANDROID_BASE
+
+    git(d, 'init', '-q')
+    git(d, 'config', 'user.email', 'bench@phone-lab.org')
+    git(d, 'config', 'user.name', 'bench')
+    git(d, 'checkout', '-q', '-b', develop)
+    for i in range(args.files):
+        sub = os.path.join(d, 'src', 'dir%d' % (i % 4))
+        if not os.path.isdir(sub):
+            os.makedirs(sub)
+        docs = int(args.density) + (rand.random() < args.density % 1)
+        write_source(os.path.join(sub, 'file%d%s' % (i, rand.choice(
+            SOURCE_EXTS))), docs, rand)
+    with open(os.path.join(d, 'Android.mk'), 'w') as f:
+        f.write('LOCAL_MODULE := %s\n' % (os.path.basename(path)))
+    with open(os.path.join(d, 'logging.c'), 'w') as f:
+        f.write('/* develop */\n')
+    git(d, 'add', '-A')
+    git(d, 'commit', '-q', '-m', 'develop')
+    git(d, 'update-ref', '%sphonelab/android-%s/develop' %
+        (remote_prefix, base), 'HEAD')
+
+    git(d, 'checkout', '-q', '-b', 'logging', develop)
+    with open(os.path.join(d, 'logging.c'), 'w') as f:
+        f.write('/* logging */\n')
+    git(d, 'commit', '-q', '-a', '-m', 'logging')
+    git(d, 'update-ref', '%s%s/android-%s/main' %
+        (remote_prefix, checker.LOGGING_BRANCH_PREFIX, base), 'HEAD')
+
+    git(d, 'checkout', '-q', '-b', 'experiment', develop)
+    write_source(os.path.join(d, 'src', 'experiment.java'), 1, rand)
+    if conflict:
+        with open(os.path.join(d, 'logging.c'), 'w') as f:
+            f.write('/* experiment */\n')
+    git(d, 'add', '-A')
+    git(d, 'commit', '-q', '-m', 'experiment')
+    git(d, 'update-ref', '%s%s/android-%s/1/%s' %
+        (remote_prefix, checker.EXPERIMENT_BRANCH_PREFIX, base,
+         BENCH_EXPERIMENT), 'HEAD')
+
+    git(d, 'checkout', '-q', '-b', 'phonelab/%s/release-1' % (args.aosp),
+        develop)
+    write_source(os.path.join(d, 'src', 'release.c'), 1, rand)
+    git(d, 'add', '-A')
+    git(d, 'commit', '-q', '-m', 'release')
+    for b in ['logging', 'experiment']:
+        git(d, 'branch', '-q', '-D', b)
+
+
+def generate_tree(root, projects, args):
+    """Create a synthetic AOSP tree.
+
+    Generation is deterministic for the same ``args.seed``.
+
+    Args:
+        root (str): tree root, must not exist.
+        projects (int): number of projects.
+        args: parsed command line arguments.
+
+    Returns:
+        list: project paths.
+    """
+    rand = random.Random(args.seed)
+    paths = ['frameworks/base'] + ['%s/proj%d' % (
+        rand.choice(['packages', 'hardware', 'external']), i)
+        for i in range(projects - 1)]
+    conflicts = set(rand.sample(paths, int(round(len(paths) *
+                                                 args.conflicts))))
+
+    os.makedirs(os.path.join(root, '.repo', 'manifests'))
+    with open(os.path.join(root, '.repo', 'manifests', 'default.xml'),
+              'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<manifest>\n')
+        f.write('  <remote name="%s" fetch=".." />\n' %
+                (checker.DEFAULT_REMOTE))
+        f.write('  <default revision="master" remote="%s" />\n' %
+                (checker.DEFAULT_REMOTE))
+        for path in paths:
+            f.write('  <project path="%s" name="platform/%s" />\n' %
+                    (path, path))
+        f.write('</manifest>\n')
+
+    for path in paths:
+        generate_project(root, path, args, rand, path in conflicts)
+    return paths
+
+
+def measure(func, repeat):
+    """Time ``func`` ``repeat`` times.
+
+    Returns:
+        tuple: ``(timing, result)``, where ``timing`` is a dict of ``min``,
+        ``median`` and ``runs`` (all in seconds), and ``result`` is the
+        return value of the last run.
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        runs.append(time.time() - start)
+    ordered = sorted(runs)
+    return {'min': ordered[0], 'median': ordered[len(ordered) // 2],
+            'runs': runs}, result
+
+
+def bench_tree(root, args):
+    """Time tagdoc and checker stages on a synthetic tree.
+
+    Returns:
+        dict: ``timings`` of each stage (see :func:`measure`), and counts of
+        projects, tag docs and conflicts processed.
+    """
+    timings = {}
+    develop = 'phonelab/%s/develop' % (args.aosp)
+
+    timings['metadata'], projs = measure(
+        lambda: tagdoc.RepoProject.load_all(root), args.repeat)
+    timings['changed_projects'], changed = measure(
+        lambda: tagdoc.find_changed_projects(projs, develop), args.repeat)
+
+    def scan():
+        walker = tagdoc.SourceWalker(root, [p.path for p in projs],
+                                     ignore=tagdoc.DEFAULT_IGNORE)
+        return tagdoc.TagDoc.create_from_projs(changed, jobs=args.jobs,
+                                               walker=walker)
+    timings['tag_scan'], tag_docs = measure(scan, args.repeat)
+
+    for name, formatter in sorted(tagdoc.FORMATTER_MAPPING.items()):
+        def format_docs():
+            with tempfile.TemporaryFile() as f:
+                formatter(tag_docs).write(f)
+        timings['format_%s' % (name)], _ = measure(format_docs, args.repeat)
+
+    check_args = checker.arg_parser().parse_args(
+        ['--exp', BENCH_EXPERIMENT, '--aosp_root', root, '--merge_only',
+         '--merge_j', str(args.merge_j)])
+    paths = [p.path for p in projs]
+    timings['branch_discovery'], branches = measure(
+        lambda: checker.find_branches(check_args, paths), args.repeat)
+
+    rel_info = checker.ReleaseInfo(
+        args=check_args, branches=branches, conflicts=[],
+        merge_ref='%s/bench' % (checker.MERGE_REF_PREFIX))
+
+    def merge():
+        try:
+            checker.merge_branches(rel_info)
+        except Exception:
+            # Conflicts are part of the synthetic tree.
+            pass
+        return rel_info.conflicts
+
+    cwd = os.getcwd()
+    try:
+        timings['merge'], conflicts = measure(merge, args.repeat)
+    finally:
+        checker.cleanup(rel_info)
+        os.chdir(cwd)
+
+    return {'projects': len(projs), 'changed_projects': len(changed),
+            'tag_docs': len(tag_docs), 'conflicts': len(conflicts),
+            'timings': timings}
+
+
+def compare(results, baseline):
+    """Log the change of median stage times against a baseline run."""
+    old = dict((r['projects'], r['timings']) for r in baseline['results'])
+    for r in results:
+        if r['projects'] not in old:
+            continue
+        logger.info("%d projects vs. baseline %s:" %
+                    (r['projects'], baseline['version']))
+        for stage in sorted(r['timings']):
+            if stage not in old[r['projects']]:
+                continue
+            before = old[r['projects']][stage]['median']
+            after = r['timings'][stage]['median']
+            logger.info("  %-20s %8.3f -> %8.3f sec (%+.0f%%)" %
+                        (stage, before, after,
+                         100.0 * (after - before) / before if before > 0
+                         else 0))
+
+
+def version():
+    """Commit of this tool, for telling runs apart."""
+    result = utils.run(['git', 'describe', '--always', '--dirty'],
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.output.strip() if result.ok else 'unknown'
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Numbers of projects of the trees to benchmark.")
+    parser.add_argument('--files', type=int, default=DEFAULT_FILES,
+                        help="Source files per project.")
+    parser.add_argument('--density', type=float, default=DEFAULT_DENSITY,
+                        help="Average number of tag docs per source file.")
+    parser.add_argument('--conflicts', type=float, default=DEFAULT_CONFLICTS,
+                        help="Share of projects where the experiment "
+                        "conflicts with the logging branch.")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed of tree generation.")
+    parser.add_argument('--aosp', default=tagdoc.DEFAULT_AOSP_BASE,
+                        help="AOSP base of tagdoc branch names.")
+
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="Runs of each stage.")
+    parser.add_argument('--jobs', type=int, default=tagdoc.DEFAULT_JOBS,
+                        help="Tag scan worker processes.")
+    parser.add_argument('--merge_j', type=int, default=checker.DEFAULT_MERGE_J,
+                        help="Concurrent merges.")
+
+    parser.add_argument('--work_dir', default=None,
+                        help="Where to generate trees, a temp dir by "
+                        "default. Trees are kept if given.")
+    parser.add_argument('--out', default=DEFAULT_OUT,
+                        help="JSON results file.")
+    parser.add_argument('--baseline', default=None,
+                        help="Results of a previous run to compare with.")
+
+    parser.add_argument('--verbose', action='store_true',
+                        help="Verbose output.")
+    return parser
+
+
+def main():
+    args = arg_parser().parse_args()
+    if not args.verbose:
+        logger.setLevel(logging.CRITICAL)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='phonelab-bench-')
+    results = []
+    try:
+        for size in args.sizes:
+            root = os.path.abspath(os.path.join(work_dir, 'tree-%d' % (size)))
+            if os.path.exists(root):
+                shutil.rmtree(root)
+            start = time.time()
+            generate_tree(root, size, args)
+            generated = time.time() - start
+
+            result = bench_tree(root, args)
+            result['generate'] = generated
+            results.append(result)
+
+            logger.setLevel(logging.INFO)
+            logger.info("%d projects, %d tag docs, %d conflicts "
+                        "(generated in %.1f sec):" %
+                        (size, result['tag_docs'], result['conflicts'],
+                         generated))
+            for stage, timing in sorted(result['timings'].items()):
+                logger.info("  %-20s %8.3f sec" % (stage, timing['median']))
+            if not args.verbose:
+                logger.setLevel(logging.CRITICAL)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    report = {
+        'version': version(),
+        'created': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'params': dict((k, getattr(args, k)) for k in
+                       ['files', 'density', 'conflicts', 'seed', 'repeat',
+                        'jobs', 'merge_j']),
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logger.setLevel(logging.INFO)
+    logger.info("Results written to %s" % (args.out))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,14 +15,25 @@ notifying us that your experiment changes are ready to deploy.
 """
 
 import argparse
+import gzip
+import hashlib
+import json
 import os
 import random
+import re
+import sqlite3
 import string
 import multiprocessing
-import subprocess
+import pipes
+import Queue
+import sys
+import threading
+import time
 
 import utils
+from manifest import Manifest
 from utils import logger, time_it
+from tagdoc import RepoProject
 
 
 EXPERIMENT_BRANCH_PREFIX = 'experiment'
@@ -35,6 +46,14 @@ more details.
 
 LOGGING_BRANCH_PREFIX = 'logging'
 
+MERGE_REF_PREFIX = 'refs/phonelab/checker'
+"""Ref namespace for in-memory merge results of ``--merge_only``.
+"""
+
+MERGE_TREE_GIT_VERSION = (2, 38)
+"""Oldest git with ``git merge-tree --write-tree``, used by ``--merge_only``.
+"""
+
 DEFAULT_ANDROID_BASE = '5.1.1_r3'
 """Default AOSP version that we forked from.
 
@@ -71,6 +90,14 @@ DEFAULT_J = multiprocessing.cpu_count() * 2
 """Default number of parallel workers.
 """
 
+DEFAULT_FETCH_J = 4
+"""Default number of projects to fetch in parallel.
+"""
+
+DEFAULT_MERGE_J = 8
+"""Default number of projects to merge in parallel.
+"""
+
 DEFAULT_TARGET = 'hammerhead'
 """Default build target.
 
@@ -86,6 +113,64 @@ See `here <http://blog.udinic.com/2014/06/04/aosp-part-2-build-variants/>`_ for
 documents on build variants.
 """
 
+DEFAULT_CCACHE_DIR = os.path.join(os.path.expanduser('~'), '.ccache')
+"""Default compiler cache directory for incremental builds.
+"""
+
+DEFAULT_CCACHE_SIZE = '50G'
+"""Default compiler cache size, as recommended by AOSP build docs.
+"""
+
+CCACHE_PREBUILT = os.path.join('prebuilts', 'misc', 'linux-x86', 'ccache',
+                               'ccache')
+"""ccache shipped in the AOSP tree.
+"""
+
+GLOBAL_BUILD_DIRS = ['build', 'device', 'vendor']
+"""Top level dirs whose changes may affect any module.
+"""
+
+BUILD_STAMP = '.phonelab_build_base'
+"""File under ``out/`` recording the develop base of the last build.
+"""
+
+BUILD_LOG = 'checker_build.log.gz'
+"""Default build log file, under ``.repo`` so ``make clean`` keeps it.
+"""
+
+BUILD_ERROR_PATTERNS = [
+    # gcc, clang, javac, aapt: path:line[:col]: [fatal ]error: ...
+    r'^[^\s:]+:\d+:(\d+:)? (fatal )?error: ',
+    r'^(\S+-)?ld(\.\w+)?: (fatal )?error: ',
+    r'undefined reference to ',
+    r'^collect2: error: ',
+    r'^clang(\+\+)?: error: ',
+    r'^make(\[\d+\])?: \*\*\* ',
+    r'^FAILED: ',
+]
+"""Build output lines reporting compiler, linker and make errors.
+"""
+
+BUILD_PROGRESS_RE = re.compile(r'^\[\s*(\d+)% (\d+)/(\d+)\]')
+"""Build progress lines, e.g. ``[ 42% 1234/2938] target ...``.
+"""
+
+BUILD_PROGRESS_INTERVAL = 60
+"""Seconds between build progress log lines.
+"""
+
+MAX_BUILD_ERRORS = 20
+"""Number of build error lines kept to report.
+"""
+
+DEFAULT_BATCH_OUT = os.path.join(os.getcwd(), 'conflict_matrix.json')
+"""Default conflict matrix output file of ``--batch``.
+"""
+
+DEFAULT_RESULTS_MAX_AGE = 7
+"""Default number of days to keep check results.
+"""
+
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -108,6 +193,15 @@ class ReleaseInfo(object):
             setattr(self, attr, val)
 
 
+class MergeConflict(Exception):
+    """Branches do not merge cleanly.
+
+    Unlike other failures, this only depends on the commits being checked,
+    so it is kept in the :class:`ResultStore`.
+    """
+    pass
+
+
 def arg_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -119,6 +213,17 @@ def arg_parser():
                         help="Root of AOSP tree.")
     parser.add_argument('--j', type=int, default=DEFAULT_J,
                         help="# of processes for parallel build.")
+    parser.add_argument('--fetch_j', type=int, default=DEFAULT_FETCH_J,
+                        help="# of projects to fetch in parallel.")
+    parser.add_argument('--fetch', default='targeted',
+                        choices=['targeted', 'full'],
+                        help="Fetch only develop, logging and experiment "
+                        "branches, or everything from the remote.")
+    parser.add_argument('--mirror', default=None,
+                        help="Local repo mirror to fetch from before fetching "
+                        "from the remote.")
+    parser.add_argument('--merge_j', type=int, default=DEFAULT_MERGE_J,
+                        help="# of projects to merge in parallel.")
     parser.add_argument('--target', default=DEFAULT_TARGET,
                         help="Build target.")
     parser.add_argument('--variant', default=DEFAULT_VARIANT,
@@ -131,7 +236,47 @@ def arg_parser():
     parser.add_argument('--dev', default=DEFAULT_DEVELOP_BRANCH,
                         help="Development branch.")
 
-    parser.add_argument('--merge_only', action='store_true', default=False)
+    parser.add_argument('--build', default='full',
+                        choices=['full', 'incremental', 'affected'],
+                        help="Clean build, incremental build with ccache "
+                        "that keeps out/ while develop does not change, or "
+                        "incremental build of changed modules only.")
+    parser.add_argument('--clean', action='store_true', default=False,
+                        help="Force a clean build in incremental mode.")
+    parser.add_argument('--ccache_dir', default=DEFAULT_CCACHE_DIR,
+                        help="Compiler cache directory.")
+    parser.add_argument('--ccache_size', default=DEFAULT_CCACHE_SIZE,
+                        help="Compiler cache max size.")
+    parser.add_argument('--build_log', default=None,
+                        help="Compressed build output log. "
+                        "Default: <aosp_root>/.repo/%s" % (BUILD_LOG))
+    parser.add_argument('--fail_fast', action='store_true', default=False,
+                        help="Stop the build at the first error, instead of "
+                        "finishing the remaining jobs.")
+
+    parser.add_argument('--merge_only', action='store_true', default=False,
+                        help="Only check that branches merge cleanly, in "
+                        "memory, without touching the checkout or building.")
+
+    parser.add_argument('--batch', action='store_true', default=False,
+                        help="Check each experiment against develop and each "
+                        "pair of experiments against each other, in memory.")
+    parser.add_argument('--batch_out', default=DEFAULT_BATCH_OUT,
+                        help="Conflict matrix output file of batch mode.")
+
+    parser.add_argument('--results', default=None,
+                        help="Check result store. "
+                        "Default: <aosp_root>/.repo/checker_results.sqlite")
+    parser.add_argument('--results_max_age', type=int,
+                        default=DEFAULT_RESULTS_MAX_AGE,
+                        help="Days to keep check results.")
+    parser.add_argument('--force', action='store_true', default=False,
+                        help="Check again even if the same commits were "
+                        "checked before.")
+
+    parser.add_argument('--trace', default=None,
+                        help="Write a Chrome trace of stages, projects and "
+                        "commands to this file, and log a timing summary.")
 
     parser.add_argument('--verbose', action='store_true',
                         help="Verbose output.")
@@ -142,15 +287,72 @@ def parse_args(rel_info):
     parser = arg_parser()
     args = parser.parse_args()
 
-    for d in ['aosp_root']:
-        setattr(args, d, os.path.abspath(getattr(args, d)))
+    for d in ['aosp_root', 'mirror', 'trace', 'build_log']:
+        if getattr(args, d) is not None:
+            setattr(args, d, os.path.abspath(getattr(args, d)))
 
     if not os.path.isdir(os.path.join(args.aosp_root, '.repo')):
         raise Exception("Invalide AOSP root: %s" % (args.aosp_root))
 
+    if args.results is None:
+        args.results = os.path.join(args.aosp_root, '.repo',
+                                    'checker_results.sqlite')
+
+    if args.build_log is None:
+        args.build_log = os.path.join(args.aosp_root, '.repo', BUILD_LOG)
+
+    if args.batch:
+        # Batch checks are always done in memory.
+        args.merge_only = True
+
+    if args.merge_only:
+        version = git_version()
+        if version < MERGE_TREE_GIT_VERSION:
+            raise Exception(
+                "--merge_only and --batch need git %s or newer for git "
+                "merge-tree --write-tree, found git %s." %
+                ('.'.join(str(v) for v in MERGE_TREE_GIT_VERSION),
+                 '.'.join(str(v) for v in version)))
+
+    if args.trace is not None:
+        utils.enable_trace()
+
     rel_info.args = args
 
 
+def git_version():
+    """Version of the git on ``PATH``, e.g. ``(2, 39, 5)``."""
+    out = utils.run(['git', '--version']).check().output
+    m = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', out)
+    if m is None:
+        raise Exception("Can not parse git version: %s" % (out.strip()))
+    return tuple(int(g) for g in m.groups() if g is not None)
+
+
+@time_it
+def fetch_branches(rel_info):
+    """Fetch latest PhoneLab develop, logging and experiment branches.
+    """
+    args = rel_info.args
+
+    os.chdir(args.aosp_root)
+
+    logger.info("Fetching latest PhoneLab develop branch: %s" % (args.dev))
+    if args.fetch == 'full':
+        utils.repo_forall('git fetch %s' % (args.remote), verbose=args.verbose,
+                          jobs=args.fetch_j)
+    else:
+        refspecs = ' '.join(fetch_refspecs(args))
+        cmd = 'git fetch %s %s' % (args.remote, refspecs)
+        if args.mirror is not None:
+            # Objects already in the local mirror are not fetched again from
+            # the remote. A project missing in the mirror is not an error.
+            cmd = 'git fetch %s/$REPO_PROJECT.git %s; %s' % (
+                args.mirror, refspecs, cmd)
+        utils.repo_forall(pipes.quote(cmd), verbose=args.verbose,
+                          jobs=args.fetch_j)
+
+
 @time_it
 def setup_test_branch(rel_info):
     """Set up temporal test branch.
@@ -161,8 +363,11 @@ def setup_test_branch(rel_info):
 
     os.chdir(args.aosp_root)
 
-    logger.info("Fetching latest PhoneLab develop branch: %s" % (args.dev))
-    utils.repo_forall('git fetch %s' % (args.remote), verbose=args.verbose)
+    if args.merge_only:
+        # Merges are done in memory, results are only kept under this ref.
+        rel_info.test_branch = None
+        rel_info.merge_ref = '%s/%s' % (MERGE_REF_PREFIX, rand_string(16))
+        return
 
     branch = rand_string()
     logger.info("Creating temp branch %s" % (branch))
@@ -172,119 +377,912 @@ def setup_test_branch(rel_info):
     rel_info.test_branch = branch
 
 
+def fetch_refspecs(args):
+    """Refspecs of the branches a check needs.
+
+    These are the develop branch, all logging branches, and the experiment
+    branches named ``experiment/android-$tag/$id/$exp`` for each ``--exp``.
+    """
+    refspecs = ['+refs/heads/%s:refs/remotes/%s/%s' %
+                (args.dev, args.remote, args.dev)]
+    prefixes = ['%s/android-%s/*' % (LOGGING_BRANCH_PREFIX, args.aosp_base)]
+    prefixes.extend('%s/android-%s/*/%s' %
+                    (EXPERIMENT_BRANCH_PREFIX, args.aosp_base, e)
+                    for e in args.exp)
+    for prefix in prefixes:
+        refspecs.append('+refs/heads/%s:refs/remotes/%s/%s' %
+                        (prefix, args.remote, prefix))
+    return refspecs
+
+
 @time_it
 def merge_branches(rel_info):
     """Merge the experiment branch.
 
-    First figure out the exact branch name, then merge the experiment into the
-    test branch.
+    First figure out the exact branch names from the remote refs of all
+    projects, then merge the experiment into the test branch of each project
+    that has it.
 
     Throws:
       Exception: if the experiment branch does not exist.
     """
     args = rel_info.args
 
-    os.chdir(os.path.join(args.aosp_root, 'frameworks', 'base'))
+    projs = [p.path for p in Manifest.load(args.aosp_root).projects()]
+    if getattr(rel_info, 'branches', None) is None:
+        rel_info.branches = find_branches(args, projs)
+    ref_index, logging_branches, exp_branches = rel_info.branches
+
+    branches = logging_branches + exp_branches
+    logger.info("Merging %d branches into %d projects..." %
+                (len(branches), len(projs)))
+
+    def merge(proj):
+        with utils.span('merge_project', proj=proj):
+            if args.merge_only:
+                return merge_project_in_memory(
+                    args, proj, logging_branches, exp_branches,
+                    rel_info.merge_ref, ref_index[proj])
+            return merge_project(args, proj, logging_branches, exp_branches,
+                                 ref_index[proj])
+
+    runner = utils.Runner(min(args.merge_j, len(projs)))
+    try:
+        results = runner.map(merge, projs)
+    finally:
+        runner.close()
+
+    rel_info.conflicts = [(proj, b, files)
+                          for proj, failures in zip(projs, results)
+                          for b, files in failures]
+    if len(rel_info.conflicts) > 0:
+        logger.error("Failed to merge %d branches in %d projects:" %
+                     (len(rel_info.conflicts),
+                      len(set(c[0] for c in rel_info.conflicts))))
+        for proj, b, files in rel_info.conflicts:
+            logger.error("  %s: %s" % (proj, b))
+            for f in files:
+                logger.error("    %s" % (f))
+        raise MergeConflict("Merge failed in %d projects." %
+                        (len(set(c[0] for c in rel_info.conflicts))))
+
+
+def find_branches(args, projs):
+    """Find logging branches and branches of the experiments to check.
+
+    Returns:
+        tuple: ``(ref_index, logging_branches, exp_branches)``, see
+        :func:`build_ref_index`.
 
+    Throws:
+      Exception: if the experiment branch does not exist.
+    """
     logger.debug("Parsing experiment branches.")
-    lines = subprocess.check_output('git branch -a', shell=True)
+    ref_index = build_ref_index(args, projs)
+    all_branches = set(b for refs in ref_index.values() for b in refs)
 
     exp_branches = []
     logging_branches = []
-    for line in sorted(lines.split('\n')):
-        line = line.strip()
-        b = '/'.join(line.split('/')[1:])
-        if line.startswith('remotes/%s/%s/android-%s' %
-                           (args.remote, LOGGING_BRANCH_PREFIX, args.aosp_base)):
+    for b in sorted(all_branches):
+        if b.startswith('%s/%s/' % (args.remote, LOGGING_BRANCH_PREFIX)):
             logger.info("Find logging branch %s" % (b))
             logging_branches.append(b)
-
-        if line.startswith('remotes/%s/%s/android-%s' %
-                           (args.remote,
-                            EXPERIMENT_BRANCH_PREFIX, args.aosp_base)):
-            if any([e in b for e in args.exp]):
-                logger.info("Find experiment branch %s" % (b))
-                exp_branches.append(b)
+        elif any([e in b for e in args.exp]):
+            logger.info("Find experiment branch %s" % (b))
+            exp_branches.append(b)
 
     if len(exp_branches) == 0:
         raise Exception(
             "No experiment branch found for experiment %s" % (args.exp))
 
-    os.chdir(args.aosp_root)
+    return ref_index, logging_branches, exp_branches
+
+
+@time_it
+def check_batch(rel_info):
+    """Check experiments against develop and against each other.
 
-    logger.info("Merging logging branches...")
-    for b in logging_branches:
-        utils.repo_forall('git merge %s -m "merge"' % (b), verbose=args.verbose)
+    Each experiment is merged in memory on top of develop (and the logging
+    branches), and so is each pair of experiments. All checks run on the
+    merge thread pool, without touching any worktree. A pair only reports
+    conflicts that neither experiment has on its own, so its cell shows
+    whether the two experiments conflict with each other. The resulting
+    conflict matrix is written as JSON to ``--batch_out`` and logged as a
+    table.
 
-    projs = utils.get_repo_projs(args.aosp_root)
-    for exp in exp_branches:
-        logger.info("Merging %s ..." % (exp))
+    Throws:
+      Exception: if any check has conflicts.
+    """
+    args = rel_info.args
 
+    projs = [p.path for p in Manifest.load(args.aosp_root).projects()]
+    ref_index, logging_branches, exp_branches = find_branches(args, projs)
+    exps = [e for e in args.exp if any(e in b for b in exp_branches)]
+    for e in args.exp:
+        if e not in exps:
+            logger.warn("No experiment branch found for experiment %s" % (e))
+
+    pairs = [(i, j) for i in range(len(exps)) for j in range(i, len(exps))]
+    tasks = []
+    for i, j in pairs:
+        branches = [b for b in exp_branches if exps[i] in b or exps[j] in b]
         for proj in projs:
-            os.chdir(os.path.join(args.aosp_root, proj))
-            try:
-                utils.call('git merge %s -m "test merge"' % (exp), verbose=args.verbose)
-            except:
-                logger.error("Failed to merge %s in repo %s" % (exp, proj))
-                raise
-            finally:
-                os.chdir(os.path.join(args.aosp_root))
+            if any(b in ref_index[proj] for b in branches):
+                tasks.append((i, j, proj, branches))
+
+    logger.info("Checking %d experiments, %d merges in %d projects..." %
+                (len(exps), len(pairs), len(set(t[2] for t in tasks))))
+
+    def check(task):
+        i, j, proj, branches = task
+        return merge_project_in_memory(args, proj, logging_branches, branches,
+                                       None, ref_index[proj])
+
+    runner = utils.Runner(min(args.merge_j, len(tasks)))
+    try:
+        results = runner.map(check, tasks)
+    finally:
+        runner.close()
+
+    matrix = [[[] for _ in exps] for _ in exps]
+    for (i, j, proj, branches), failures in zip(tasks, results):
+        if i == j:
+            matrix[i][i].extend({'project': proj, 'branch': b, 'files': files}
+                                for b, files in failures)
+    # Conflicts of an experiment with develop or logging show up again in
+    # each of its pairs, only keep the new ones there.
+    own = [set((c['project'], c['branch']) for c in matrix[i][i])
+           for i in range(len(exps))]
+    for (i, j, proj, branches), failures in zip(tasks, results):
+        if i == j:
+            continue
+        for b, files in failures:
+            if (proj, b) in own[i] or (proj, b) in own[j]:
+                continue
+            conflict = {'project': proj, 'branch': b, 'files': files}
+            matrix[i][j].append(conflict)
+            matrix[j][i].append(conflict)
+
+    with open(args.batch_out, 'w') as f:
+        json.dump({'develop': args.dev, 'experiments': exps,
+                   'conflicts': matrix}, f, indent=2, sort_keys=True)
+    logger.info("Conflict matrix written to %s" % (args.batch_out))
+
+    width = max([len(e) for e in exps] + [len('CONFLICT')])
+    logger.info('%s  %s' % (' ' * width,
+                            '  '.join(e.ljust(width) for e in exps)))
+    for i, e in enumerate(exps):
+        logger.info('%s  %s' % (e.ljust(width), '  '.join(
+            ('CONFLICT' if matrix[i][j] else 'ok').ljust(width)
+            for j in range(len(exps)))))
+
+    rel_info.conflicts = [(c['project'], c['branch'], c['files'])
+                          for i, j in pairs for c in matrix[i][j]]
+    if len(rel_info.conflicts) > 0:
+        raise MergeConflict("%d of %d checks have conflicts." %
+                        (len([p for p in pairs if matrix[p[0]][p[1]]]),
+                         len(pairs)))
+
+
+def build_ref_index(args, projs):
+    """Find experiment and logging branches of each project.
+
+    Runs one ``git for-each-ref`` per project, ``--merge_j`` at a time.
+
+    Args:
+        args: parsed command line arguments.
+        projs (list): project paths relative to AOSP root.
+
+    Returns:
+        dict: project path to a dict of branch name (e.g.
+        ``aosp/experiment/android-5.1.1_r3/...``) to commit SHA.
+    """
+    patterns = ['refs/remotes/%s/%s/android-%s/' %
+                (args.remote, prefix, args.aosp_base)
+                for prefix in [EXPERIMENT_BRANCH_PREFIX,
+                               LOGGING_BRANCH_PREFIX]]
+
+    def list_refs(proj):
+        out = runner.run(
+            ['git', 'for-each-ref', '--format=%(objectname) %(refname)'] +
+            patterns, cwd=os.path.join(args.aosp_root, proj)).check().output
+        refs = {}
+        for line in out.splitlines():
+            sha, ref = line.split(' ', 1)
+            refs[ref[len('refs/remotes/'):]] = sha
+        return refs
+
+    runner = utils.Runner(min(args.merge_j, len(projs)))
+    try:
+        return dict(zip(projs, runner.map(list_refs, projs)))
+    finally:
+        runner.close()
+
+
+def pending_merges(cwd, head, logging_branches, exp_branches, refs):
+    """Branches that still need to be merged into ``head`` of a project.
+
+    Branches missing in the project, or already merged into ``head``, are
+    skipped.
+
+    Returns:
+        list: ``(branch, message)`` tuples, in merge order.
+    """
+    merges = []
+    for b, msg in [(b, 'merge') for b in logging_branches] + \
+            [(b, 'test merge') for b in exp_branches]:
+        if b not in refs:
+            continue
+        if utils.run(['git', 'merge-base', '--is-ancestor', refs[b], head],
+                     cwd=cwd).ok:
+            continue
+        merges.append((b, msg))
+    return merges
+
+
+def merge_project(args, proj, logging_branches, exp_branches, refs):
+    """Merge branches into one project, in order.
+
+    A failed merge is aborted so that the remaining branches can still be
+    tried, and all failures are reported.
+
+    Args:
+        args: parsed command line arguments.
+        proj (str): project path relative to AOSP root.
+        logging_branches (list): logging branches to merge first.
+        exp_branches (list): experiment branches to merge.
+        refs (dict): branches of this project, see :func:`build_ref_index`.
+
+    Returns:
+        list: ``(branch, conflict_files)`` tuples of failed merges.
+        ``conflict_files`` is empty if the merge failed for other reasons.
+    """
+    cwd = os.path.join(args.aosp_root, proj)
+    failures = []
+    for b, msg in pending_merges(cwd, 'HEAD', logging_branches, exp_branches,
+                                 refs):
+        result = utils.run(['git', 'merge', b, '-m', msg], cwd=cwd,
+                           verbose=args.verbose)
+        if result.ok:
+            continue
+        files = utils.run(['git', 'diff', '--name-only', '--diff-filter=U'],
+                          cwd=cwd).check().output.split()
+        if utils.run(['git', 'rev-parse', '-q', '--verify', 'MERGE_HEAD'],
+                     cwd=cwd).ok:
+            utils.call('git merge --abort', verbose=args.verbose, cwd=cwd)
+        elif len(files) == 0:
+            logger.error("(%s) git merge %s failed:\n%s" %
+                         (proj, b, result.tail.rstrip()))
+        failures.append((b, files))
+    return failures
+
+
+def merge_project_in_memory(args, proj, logging_branches, exp_branches, ref,
+                            refs):
+    """Merge branches into one project without touching its worktree.
+
+    Each merge is computed by ``git merge-tree --write-tree`` (git 2.38+),
+    starting from the remote develop branch, and recorded as a commit that
+    only ``ref`` points to. The worktree, index and branches are untouched.
+
+    Args:
+        args: parsed command line arguments.
+        proj (str): project path relative to AOSP root.
+        logging_branches (list): logging branches to merge first.
+        exp_branches (list): experiment branches to merge.
+        ref (str): ref to point to the merge result, or ``None`` to only
+            check the merges.
+        refs (dict): branches of this project, see :func:`build_ref_index`.
+
+    Returns:
+        list: ``(branch, conflict_files)`` tuples of failed merges, see
+        :func:`merge_project`.
+    """
+    cwd = os.path.join(args.aosp_root, proj)
+    head = utils.run(['git', 'rev-parse', '%s/%s^{commit}' %
+                      (args.remote, args.dev)], cwd=cwd).check().output.strip()
+
+    failures = []
+    for b, msg in pending_merges(cwd, head, logging_branches, exp_branches,
+                                 refs):
+        result = utils.run(['git', 'merge-tree', '--write-tree',
+                            '--name-only', '--no-messages', head, b],
+                           cwd=cwd, verbose=args.verbose)
+        lines = result.output.splitlines()
+        if result.returncode == 0:
+            head = utils.run(['git', 'commit-tree', lines[0], '-p', head,
+                              '-p', b, '-m', msg],
+                             cwd=cwd).check().output.strip()
+        elif result.returncode == 1:
+            failures.append((b, [l for l in lines[1:] if l]))
+        else:
+            # Not a conflict, the merge could not be computed at all.
+            logger.error("(%s) git merge-tree %s failed:\n%s" %
+                         (proj, b, result.tail.rstrip()))
+            result.check()
+
+    if ref is not None:
+        utils.call('git update-ref %s %s' % (ref, head), verbose=args.verbose,
+                   cwd=cwd)
+    return failures
 
 
 @time_it
 def build_platform(rel_info):
-    """Do a clean build of the platform (w/ experiment changes).
+    """Build the platform (w/ experiment changes).
+
+    With ``--build full``, always do a clean build. With ``--build
+    incremental``, keep ``out/`` and compiler cache across checks, and only
+    clean when the develop base changed since the last build or ``--clean``
+    is given. ``--build affected`` works like ``incremental``, but only builds
+    modules in dirs changed against develop (see
+    :func:`affected_module_dirs`).
     """
     args = rel_info.args
 
     logger.info("Building platform.")
     os.chdir(args.aosp_root)
-    utils.call('make clean', verbose=args.verbose)
-    utils.call('make -j %d dist' % (args.j), verbose=args.verbose)
+
+    if args.build == 'full':
+        utils.call('make clean', verbose=args.verbose, new_group=True)
+        run_build(args, 'make -j %d dist' % (args.j))
+        return
+
+    base = develop_base(args)
+    stamp = os.path.join(args.aosp_root, 'out', BUILD_STAMP)
+    last_base = None
+    if os.path.isfile(stamp):
+        with open(stamp, 'r') as f:
+            last_base = f.read().strip()
+
+    if args.clean or base != last_base:
+        logger.info("Clean build: %s." % ("requested" if args.clean else
+                                           "develop base changed"))
+        utils.call('make clean', verbose=args.verbose, new_group=True)
+    else:
+        logger.info("Incremental build on develop base %s." % (base[:12]))
+
+    env = dict(os.environ, USE_CCACHE='1', CCACHE_DIR=args.ccache_dir)
+    ccache = ccache_binary(args)
+    if ccache is not None:
+        utils.call('%s -M %s' % (ccache, args.ccache_size),
+                   verbose=args.verbose, env=env)
+        utils.call('%s -z' % (ccache), verbose=args.verbose, env=env)
+    else:
+        logger.warn("ccache not found, building without compiler cache.")
+
+    if not os.path.isdir(os.path.dirname(stamp)):
+        os.makedirs(os.path.dirname(stamp))
+    with open(stamp, 'w') as f:
+        f.write(base)
+
+    cmd = 'make -j %d dist' % (args.j)
+    if args.build == 'affected':
+        dirs = affected_module_dirs(args)
+        if dirs is None:
+            logger.info("Changes outside of any module, building everything.")
+        elif len(dirs) == 0:
+            logger.info("No module affected, skipping build.")
+            return
+        else:
+            # mmma is defined by envsetup.sh, and builds the modules in the
+            # given dirs along with their dependencies.
+            cmd = "bash -c 'source build/envsetup.sh > /dev/null && " \
+                "mmma -j %d %s'" % (args.j, ' '.join(dirs))
+
+    try:
+        run_build(args, cmd, env=env)
+    finally:
+        if ccache is not None:
+            report_ccache_stats(ccache, env)
+
+
+class BuildMonitor(object):
+    """Scans build output lines for errors and progress, as they come.
+
+    Attributes:
+        fail_fast (bool): ask to stop the build at the first error.
+        errors (list): first :data:`MAX_BUILD_ERRORS` error lines.
+        error_count (int): number of error lines.
+        progress (tuple): last ``(percent, done, total)`` seen, or ``None``.
+    """
+
+    ERROR_RE = re.compile('|'.join('(?:%s)' % (p)
+                                   for p in BUILD_ERROR_PATTERNS))
+
+    def __init__(self, fail_fast=False):
+        self.fail_fast = fail_fast
+        self.errors = []
+        self.error_count = 0
+        self.progress = None
+        self._last_report = time.time()
+
+    def __call__(self, line):
+        """Scan one line.
+
+        Returns:
+            bool: ``True`` if the build should be stopped.
+        """
+        m = BUILD_PROGRESS_RE.match(line)
+        if m is not None:
+            self.progress = tuple(int(g) for g in m.groups())
+            now = time.time()
+            if now - self._last_report >= BUILD_PROGRESS_INTERVAL:
+                self._last_report = now
+                logger.info("Build progress: %d%% (%d/%d)" % self.progress)
+            return False
+
+        if self.ERROR_RE.search(line) is None:
+            return False
+        self.error_count += 1
+        if len(self.errors) < MAX_BUILD_ERRORS:
+            self.errors.append(line.rstrip())
+        if self.error_count == 1:
+            logger.error("Build error: %s" % (line.rstrip()))
+            if self.fail_fast:
+                logger.info("Stopping build at first error (--fail_fast).")
+        return self.fail_fast
+
+
+def run_build(args, cmd, env=None):
+    """Run a build command, keeping its output in the build log.
+
+    Output is compressed into ``--build_log`` and scanned for errors and
+    progress while the build runs. With ``--fail_fast``, the build is stopped
+    at the first error.
+
+    Throws:
+        utils.CommandError: if the build failed.
+    """
+    monitor = BuildMonitor(args.fail_fast)
+    logger.info("Build log: %s" % (args.build_log))
+    # Fast compression, the build should not wait on its log.
+    with gzip.open(args.build_log, 'wb', compresslevel=1) as log:
+        result = utils.run(cmd, cwd=args.aosp_root, env=env,
+                           verbose=args.verbose, max_output=0,
+                           new_group=True, log=log, on_line=monitor)
+
+    if monitor.progress is not None:
+        logger.info("Build progress: %d%% (%d/%d)" % monitor.progress)
+    if result.ok:
+        return
+    if monitor.errors:
+        logger.error("Build failed, %d error lines, first ones:\n%s" %
+                     (monitor.error_count, '\n'.join(monitor.errors)))
+    elif not args.verbose:
+        logger.error("Build failed, output tail:\n%s" % (result.tail))
+    logger.error("Full build output: %s" % (args.build_log))
+    result.check()
+
+
+def affected_module_dirs(args):
+    """Find module dirs affected by changes against the develop branch.
+
+    Each file changed between the remote develop branch and ``HEAD`` is
+    mapped to the nearest directory above it, within its project, that has
+    an ``Android.mk``.
+
+    Returns:
+        list: module dirs relative to AOSP root, sorted. ``None`` if some
+        change can not be mapped to a module, or touches build files that
+        may affect any module.
+    """
+    projs = RepoProject.load_all(args.aosp_root)
+
+    def changed_files(proj):
+        return runner.run(['git', 'diff', '--name-only',
+                           '%s/%s' % (args.remote, args.dev), 'HEAD'],
+                          cwd=proj.abs_path).check().output.split()
+
+    runner = utils.Runner(min(args.merge_j, len(projs)))
+    try:
+        results = runner.map(changed_files, projs)
+    finally:
+        runner.close()
+
+    dirs = set()
+    for proj, files in zip(projs, results):
+        if len(files) > 0 and proj.path.split('/')[0] in GLOBAL_BUILD_DIRS:
+            logger.info("Build system project %s changed." % (proj.path))
+            return None
+        for f in files:
+            d = os.path.dirname(f)
+            while not os.path.isfile(os.path.join(proj.abs_path, d,
+                                                  'Android.mk')):
+                if d == '':
+                    logger.info("No module found for %s/%s." % (proj.path, f))
+                    return None
+                d = os.path.dirname(d)
+            dirs.add(os.path.normpath(os.path.join(proj.path, d)))
+
+    for d in sorted(dirs):
+        mk = os.path.join(args.aosp_root, d, 'Android.mk')
+        with open(mk, 'r') as f:
+            modules = re.findall(r'^\s*LOCAL_MODULE\s*:=\s*(\S+)', f.read(),
+                                 re.MULTILINE)
+        logger.info("Affected %s: %s" % (d, ', '.join(modules) or '-'))
+
+    return sorted(dirs)
+
+
+def develop_base(args):
+    """A digest of the develop branch commits of all projects.
+
+    Returns:
+        str: hex digest that changes whenever develop moves in any project.
+    """
+    projs = [p.path for p in Manifest.load(args.aosp_root).projects()]
+    shas = develop_commits(args, projs)
+    lines = ['%s %s' % (proj, sha) for proj, sha in zip(projs, shas)]
+    lines.append('%s-%s' % (args.target, args.variant))
+    return hashlib.sha1('\n'.join(lines)).hexdigest()
+
+
+def develop_commits(args, projs):
+    """Resolve the remote develop branch in each project, concurrently.
+
+    Args:
+        args: parsed command line arguments.
+        projs (list): project paths relative to AOSP root.
+
+    Returns:
+        list: commit SHAs, in the order of ``projs``.
+    """
+    def resolve(proj):
+        return runner.run(['git', 'rev-parse',
+                           '%s/%s' % (args.remote, args.dev)],
+                          cwd=os.path.join(args.aosp_root, proj)
+                          ).check().output.strip()
+
+    runner = utils.Runner(min(args.merge_j, len(projs)))
+    try:
+        return runner.map(resolve, projs)
+    finally:
+        runner.close()
+
+
+def ccache_binary(args):
+    """Find ccache, preferring the one shipped with AOSP."""
+    prebuilt = os.path.join(args.aosp_root, CCACHE_PREBUILT)
+    if os.path.isfile(prebuilt):
+        return prebuilt
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.isfile(os.path.join(d, 'ccache')):
+            return os.path.join(d, 'ccache')
+    return None
+
+
+def report_ccache_stats(ccache, env):
+    """Log compiler cache hit rate of this build."""
+    result = utils.run([ccache, '-s'], env=env)
+    if not result.ok:
+        logger.warn("Failed to get ccache stats, exit status %d:\n%s" %
+                    (result.returncode, result.tail.rstrip()))
+        return
+    stats = result.output
+
+    counts = {}
+    for line in stats.splitlines():
+        m = re.match(r'\s*(cache hit \(direct\)|cache hit \(preprocessed\)|'
+                     r'cache miss|Hits|Misses):?\s+(\d+)', line)
+        if m is not None:
+            counts[m.group(1)] = int(m.group(2))
+
+    hits = counts.get('cache hit (direct)', 0) + \
+        counts.get('cache hit (preprocessed)', 0) + counts.get('Hits', 0)
+    misses = counts.get('cache miss', 0) + counts.get('Misses', 0)
+    if hits + misses == 0:
+        logger.info("ccache stats:\n%s" % (stats))
+        return
+    logger.info("ccache: %d hits, %d misses, hit rate %.1f%%." %
+                (hits, misses, 100.0 * hits / (hits + misses)))
 
 
 @time_it
 def test_tag_doc(rel_info):
-    os.chdir(rel_info.args.aosp_root)
-    utils.call('python %s --out /dev/null' %
-               (os.path.join(PROJECT_ROOT, 'tagdoc.py')))
+    """Validate tag docs changed by the merged branches.
+
+    Fails on invalid docs, empty required fields and duplicate (tag, action)
+    pairs, see ``tagdoc.py --validate``.
+    """
+    args = rel_info.args
+    os.chdir(args.aosp_root)
+    cmd = 'python %s --validate --jobs %d --develop %s/%s' % (
+        os.path.join(PROJECT_ROOT, 'tagdoc.py'), args.j, args.remote,
+        args.dev)
+    if args.merge_only:
+        # Merge results are not checked out, scan them from git objects.
+        cmd += ' --ref %s' % (rel_info.merge_ref)
+    utils.call(cmd, verbose=args.verbose, new_group=True)
+
+
+class ResultStore(object):
+    """Persistent store of check results.
+
+    Results are keyed by :func:`result_key`, and kept in a SQLite file for
+    ``max_age`` seconds. Only passes and :class:`MergeConflict` failures are
+    stored, other failures may not happen again with the same commits.
+    """
+
+    def __init__(self, path, max_age):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                          '(key TEXT PRIMARY KEY, created REAL, '
+                          'passed INTEGER, timings TEXT, conflicts TEXT)')
+        self.conn.execute('DELETE FROM results WHERE created < ?',
+                          (time.time() - max_age,))
+        self.conn.commit()
+
+    def get(self, key):
+        """Look up a result.
+
+        Returns:
+            dict: with ``created``, ``passed``, ``timings`` and ``conflicts``,
+            or ``None`` if not found.
+        """
+        row = self.conn.execute(
+            'SELECT created, passed, timings, conflicts FROM results '
+            'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'created': row[0],
+            'passed': bool(row[1]),
+            'timings': json.loads(row[2]),
+            'conflicts': json.loads(row[3]),
+        }
+
+    def put(self, key, passed, timings, conflicts):
+        self.conn.execute('INSERT OR REPLACE INTO results VALUES '
+                          '(?, ?, ?, ?, ?)',
+                          (key, time.time(), int(passed), json.dumps(timings),
+                           json.dumps(conflicts)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def result_key(rel_info):
+    """Key of a check result.
+
+    Covers the develop commit of each project, the commits of the logging and
+    experiment branches being merged, and the settings that change the
+    verdict: build target and variant, ``--merge_only``, ``--build`` and
+    ``--clean``.
+
+    Returns:
+        str: hex digest.
+    """
+    args = rel_info.args
+    projs = [p.path for p in Manifest.load(args.aosp_root).projects()]
+    if getattr(rel_info, 'branches', None) is None:
+        rel_info.branches = find_branches(args, projs)
+    ref_index, logging_branches, exp_branches = rel_info.branches
+
+    key = {
+        'develop': dict(zip(projs, develop_commits(args, projs))),
+        'branches': dict((proj, dict((b, ref_index[proj][b])
+                                     for b in logging_branches + exp_branches
+                                     if b in ref_index[proj]))
+                         for proj in projs),
+        'target': args.target,
+        'variant': args.variant,
+        'merge_only': args.merge_only,
+        'build': args.build,
+        'clean': args.clean,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def run_stage(rel_info, stage):
+    """Run a check stage and record its duration in ``rel_info.timings``."""
+    start = time.time()
+    try:
+        stage(rel_info)
+    finally:
+        rel_info.timings.append((stage.__name__, time.time() - start))
+
+
+def run_stages(rel_info, stages):
+    """Run check stages as a dependency graph.
+
+    Each stage starts in its own thread as soon as all stages it depends on
+    have finished, so independent stages overlap. When a stage fails, no new
+    stage is started and commands of running stages are killed (see
+    :func:`utils.kill_running`). Durations are recorded in
+    ``rel_info.timings``, and each stage's contribution to the critical path
+    is logged at the end.
+
+    Args:
+        rel_info (ReleaseInfo): the check.
+        stages (list): ``(stage, deps)`` tuples, where ``deps`` is a list of
+            stages in ``stages``.
+
+    Throws:
+      Exception: the first stage failure, with its original traceback.
+    """
+    finished = Queue.Queue()
+
+    def run(stage):
+        try:
+            stage(rel_info)
+        except BaseException:
+            # Logged by the caller, along with the traceback kept here.
+            finished.put((stage, sys.exc_info()))
+        else:
+            finished.put((stage, None))
+
+    start = time.time()
+    times = {}
+    pending = list(stages)
+    running = 0
+    cancelled = False
+    error = None
+    while True:
+        if not cancelled:
+            for stage, deps in list(pending):
+                if all(d in times and times[d][1] is not None for d in deps):
+                    pending.remove((stage, deps))
+                    times[stage] = (time.time() - start, None)
+                    t = threading.Thread(target=run, args=(stage,),
+                                         name=stage.__name__)
+                    t.daemon = True
+                    t.start()
+                    running += 1
+        if running == 0:
+            break
+
+        try:
+            # A timeout keeps the main thread responsive to Ctrl-C.
+            stage, exc_info = finished.get(timeout=1)
+        except Queue.Empty:
+            continue
+        except KeyboardInterrupt:
+            cancelled = True
+            utils.kill_running()
+            raise
+        running -= 1
+        times[stage] = (times[stage][0], time.time() - start)
+        rel_info.timings.append((stage.__name__,
+                                 times[stage][1] - times[stage][0]))
+        if exc_info is not None and not cancelled:
+            cancelled = True
+            error = exc_info
+            logger.error("Stage %s failed." % (stage.__name__))
+            utils.kill_running()
+
+    report_critical_path(stages, times)
+    if error is not None:
+        utils.reraise(error)
+
+
+def report_critical_path(stages, times):
+    """Log the stage timeline and the critical path through it.
+
+    Args:
+        stages (list): ``(stage, deps)`` tuples.
+        times (dict): stage to ``(start, end)`` offsets in seconds. ``end`` is
+            ``None`` for stages that did not finish.
+    """
+    deps = dict(stages)
+    done = [s for s, _ in stages if s in times and times[s][1] is not None]
+    if len(done) == 0:
+        return
+
+    critical = {}
+    stage = max(done, key=lambda s: times[s][1])
+    while stage is not None:
+        # A stage starts when its last dependency finishes, so that one is
+        # the previous stage on the critical path.
+        prev = max([d for d in deps[stage] if d in times] or [None],
+                   key=lambda d: times[d][1] if d is not None else 0)
+        critical[stage] = times[stage][1] - (times[prev][1] if prev else 0)
+        stage = prev
+
+    total = max(times[s][1] for s in done)
+    logger.info("Stage timeline (total %.1f sec):" % (total))
+    for stage, _ in stages:
+        if stage not in times:
+            continue
+        start, end = times[stage]
+        logger.info("  %-20s %8.1f - %8s sec%s" % (
+            stage.__name__, start,
+            '%.1f' % (end) if end is not None else '?',
+            ', critical path %.1f sec (%.0f%%)' % (
+                critical[stage], 100.0 * critical[stage] / total)
+            if stage in critical and total > 0 else ''))
 
 
 def cleanup(rel_info):
     """Delete test branch, switch back to experiment branch.
+
+    For ``--merge_only``, delete the ref of in-memory merge results.
     """
     args = rel_info.args
     os.chdir(args.aosp_root)
 
+    if getattr(rel_info, 'merge_ref', None) is not None:
+        for proj in Manifest.load(args.aosp_root).projects():
+            utils.run(['git', 'update-ref', '-d', rel_info.merge_ref],
+                      cwd=os.path.join(args.aosp_root, proj.path))
+
 
 
 @time_it
 def main():
     rel_info = ReleaseInfo()
+    rel_info.timings = []
+    rel_info.conflicts = []
     start_directory = os.getcwd()
     parse_args(rel_info)
+    args = rel_info.args
+
+    results = None
+    key = None
+    passed = False
     try:
-        setup_test_branch(rel_info)
-        merge_branches(rel_info)
-        test_tag_doc(rel_info)
+        run_stage(rel_info, fetch_branches)
+        if args.batch:
+            run_stage(rel_info, check_batch)
+            return
 
-        if rel_info.args.merge_only:
+        results = ResultStore(args.results, args.results_max_age * 24 * 3600)
+        key = result_key(rel_info)
+        cached = None if args.force else results.get(key)
+        if cached is not None:
+            logger.info("Same develop and experiment commits were checked "
+                        "on %s (use --force to check again):" %
+                        (time.ctime(cached['created'])))
+            for stage, duration in cached['timings']:
+                logger.info("  %s: %.1f sec" % (stage, duration))
+            for proj, b, files in cached['conflicts']:
+                logger.error("  Conflict in %s: %s %s" %
+                             (proj, b, ' '.join(files)))
+            logger.info("[%s] (cached)" %
+                        ('PASS' if cached['passed'] else 'FAILED'))
+            key = None
             return
 
-        build_platform(rel_info)
+        stages = [
+            (setup_test_branch, []),
+            (merge_branches, [setup_test_branch]),
+            # Tag docs only need the merged sources, so they are checked
+            # while the platform builds.
+            (test_tag_doc, [merge_branches]),
+        ]
+        if not args.merge_only:
+            stages.append((build_platform, [merge_branches]))
+        run_stages(rel_info, stages)
+        passed = True
     except KeyboardInterrupt:
-        pass
+        utils.kill_running()
+        key = None
     except:
         logger.exception("[FAILED] Please check your changes. "\
                          "You can not pass this checker unless your branch "\
                          "can be merged without conflicts.")
-        logger.info("Note: all repos are in test branch %s" % rel_info.test_branch)
+        if not isinstance(sys.exc_info()[1], MergeConflict):
+            # Tooling, environment or network failure, check again next time.
+            key = None
+        if getattr(rel_info, 'test_branch', None) is not None:
+            logger.info("Note: all repos are in test branch %s" %
+                        rel_info.test_branch)
     else:
-        logger.info(
-            "[PASS] Your changes can be successfully merged and build.")
+        if passed:
+            logger.info(
+                "[PASS] Your changes can be successfully merged and build.")
     finally:
+        if results is not None:
+            if key is not None:
+                results.put(key, passed, rel_info.timings, rel_info.conflicts)
+            results.close()
         cleanup(rel_info)
         os.chdir(start_directory)
+        if args.trace is not None:
+            utils.trace_summary()
+            utils.write_trace(args.trace)
+            logger.info("Trace written to %s" % (args.trace))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,313 @@
+"""Repo manifest model shared by all tools.
+
+The manifest of a repo checkout is ``.repo/manifest.xml`` (or
+``.repo/manifests/default.xml`` in older checkouts), plus the files it
+``<include>``\ s and the local manifests in ``.repo/local_manifests/``. This
+module merges them the way ``repo`` does, including ``<remove-project>``, and
+caches the result in ``.repo/manifest_cache.json``, keyed by the mtimes of all
+the files involved.
+
+Example::
+
+    m = manifest.Manifest.load(aosp_root)
+    for proj in m.projects():
+        print proj.path, proj.revision
+    m.find('frameworks/base/core/java/android/app/Activity.java')
+
+"""
+
+import json
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+
+from utils import logger
+
+
+CACHE_FILE = 'manifest_cache.json'
+"""Parsed manifest cache, under ``.repo``."""
+
+CACHE_VERSION = 1
+
+DEFAULT_GROUPS = ['default']
+"""Groups synced by ``repo`` unless told otherwise.
+
+Every project is in group ``default``, unless it is in group ``notdefault``.
+"""
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+class Project(object):
+    """A project of the manifest.
+
+    Attributes:
+        name (str): project name on the remote.
+        path (str): checkout path relative to the repo root.
+        groups (list): groups the project is listed in.
+        revision (str): revision to sync, resolved from the remote and
+            ``<default>`` if not given on the project.
+        remote (str): remote name.
+    """
+
+    def __init__(self, name, path, groups, revision, remote):
+        self.name = name
+        self.path = path
+        self.groups = groups
+        self.revision = revision
+        self.remote = remote
+
+    def all_groups(self):
+        """Groups including the implicit ones ``repo`` adds."""
+        groups = ['all', 'name:%s' % (self.name), 'path:%s' % (self.path)]
+        if 'notdefault' not in self.groups:
+            groups.append('default')
+        return self.groups + groups
+
+    def in_groups(self, groups):
+        """Whether the project is selected by a ``repo init -g`` style list.
+
+        Later entries win, and a ``-`` prefix excludes a group, e.g.
+        ``['all', '-notdefault', 'device']``.
+        """
+        mine = set(self.all_groups())
+        selected = False
+        for g in groups:
+            if g.startswith('-'):
+                if g[1:] in mine:
+                    selected = False
+            elif g in mine:
+                selected = True
+        return selected
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in
+                    ['name', 'path', 'groups', 'revision', 'remote'])
+
+    def __repr__(self):
+        return 'Project(%s)' % (self.path)
+
+
+class Manifest(object):
+    """Projects of a repo checkout, in manifest order.
+
+    Use :meth:`load` instead of creating it directly.
+
+    Attributes:
+        root (str): repo root.
+        files (list): manifest files read, absolute paths.
+    """
+
+    def __init__(self, root, projects, files):
+        self.root = root
+        self.files = files
+        self._projects = projects
+        self._by_path = dict((p.path, p) for p in projects)
+        self._mtimes = None
+
+    @classmethod
+    def load(cls, root, use_cache=True):
+        """Load the manifest of a checkout.
+
+        The parsed manifest is kept in memory and on disk, and is only parsed
+        again when one of its files changes.
+
+        Args:
+            root (str): repo root.
+            use_cache (bool): ``False`` to always parse the XML.
+
+        Returns:
+            Manifest: the merged manifest.
+        """
+        root = os.path.abspath(root)
+        if use_cache:
+            with _loaded_lock:
+                m = _loaded.get(root)
+            if m is not None and m._mtimes == _mtimes(m.files, root):
+                return m
+            m = cls._load_cache(root)
+            if m is None:
+                m = cls.parse(root)
+                m._save_cache()
+            with _loaded_lock:
+                _loaded[root] = m
+            return m
+        return cls.parse(root)
+
+    @classmethod
+    def parse(cls, root):
+        """Parse manifest files of a checkout, bypassing the cache."""
+        repo_dir = os.path.join(root, '.repo')
+        entry = os.path.join(repo_dir, 'manifest.xml')
+        if not os.path.isfile(entry):
+            entry = os.path.join(repo_dir, 'manifests', 'default.xml')
+
+        parser = _Parser(os.path.join(repo_dir, 'manifests'))
+        parser.parse(entry)
+        for path in local_manifests(repo_dir):
+            parser.parse(path)
+
+        m = cls(root, parser.resolve(), parser.files)
+        m._mtimes = _mtimes(m.files, root)
+        return m
+
+    def projects(self, groups=None):
+        """Projects in manifest order.
+
+        Args:
+            groups (list): groups to select, see :meth:`Project.in_groups`.
+                Defaults to :data:`DEFAULT_GROUPS`, the projects ``repo``
+                syncs by default.
+
+        Returns:
+            list: :class:`Project` objects.
+        """
+        groups = DEFAULT_GROUPS if groups is None else groups
+        return [p for p in self._projects if p.in_groups(groups)]
+
+    def get(self, path):
+        """Project at exactly ``path``, or ``None``."""
+        return self._by_path.get(os.path.normpath(path))
+
+    def find(self, path):
+        """Innermost project containing ``path``.
+
+        Args:
+            path (str): file or dir, relative to the repo root or absolute.
+
+        Returns:
+            Project: the project, or ``None`` if ``path`` is in no project.
+        """
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.root)
+        path = os.path.normpath(path)
+        while path not in ('', '.', os.sep):
+            if path in self._by_path:
+                return self._by_path[path]
+            path = os.path.dirname(path)
+        return None
+
+    def under(self, prefix, groups=None):
+        """Projects at or below dir ``prefix``, in manifest order."""
+        prefix = os.path.normpath(prefix)
+        return [p for p in self.projects(groups)
+                if p.path == prefix or p.path.startswith(prefix + '/')]
+
+    @classmethod
+    def _load_cache(cls, root):
+        path = os.path.join(root, '.repo', CACHE_FILE)
+        try:
+            with open(path, 'r') as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cache.get('version') != CACHE_VERSION or \
+                cache['mtimes'] != _mtimes(cache['files'], root):
+            return None
+
+        m = cls(root, [Project(**dict((str(k), _native(v))
+                                      for k, v in p.items()))
+                       for p in cache['projects']], _native(cache['files']))
+        m._mtimes = cache['mtimes']
+        return m
+
+    def _save_cache(self):
+        repo_dir = os.path.join(self.root, '.repo')
+        try:
+            fd, tmp = tempfile.mkstemp(dir=repo_dir, prefix=CACHE_FILE)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'files': self.files,
+                           'mtimes': self._mtimes,
+                           'projects': [p.to_dict() for p in self._projects]},
+                          f)
+            os.rename(tmp, os.path.join(repo_dir, CACHE_FILE))
+        except (IOError, OSError) as e:
+            logger.debug("Can not cache manifest: %s" % (e))
+
+
+def local_manifests(repo_dir):
+    """Local manifest files, in the order ``repo`` applies them."""
+    paths = []
+    legacy = os.path.join(repo_dir, 'local_manifest.xml')
+    if os.path.isfile(legacy):
+        paths.append(legacy)
+    local_dir = os.path.join(repo_dir, 'local_manifests')
+    if os.path.isdir(local_dir):
+        paths.extend(os.path.join(local_dir, f)
+                     for f in sorted(os.listdir(local_dir))
+                     if f.endswith('.xml'))
+    return paths
+
+
+def _native(value):
+    """Turn unicode strings from JSON back into ``str``."""
+    if isinstance(value, list):
+        return [_native(v) for v in value]
+    if value is None or isinstance(value, str):
+        return value
+    return value.encode('utf-8')
+
+
+def _mtimes(files, root):
+    """Cache key: mtimes of manifest files, and of places new ones appear."""
+    repo_dir = os.path.join(root, '.repo')
+    mtimes = []
+    for path in files + [os.path.join(repo_dir, f) for f in
+                         ['manifest.xml', 'local_manifest.xml',
+                          'local_manifests']]:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+class _Parser(object):
+    """Collects elements of manifest files, in ``repo`` semantics."""
+
+    def __init__(self, manifests_dir):
+        self.manifests_dir = manifests_dir
+        self.files = []
+        self.remotes = {}
+        self.default = {}
+        self.projects = []
+
+    def parse(self, path):
+        path = os.path.realpath(path)
+        self.files.append(path)
+        for child in ET.parse(path).getroot():
+            if child.tag == 'include':
+                self.parse(os.path.join(self.manifests_dir,
+                                        child.attrib['name']))
+            elif child.tag == 'remote':
+                self.remotes[child.attrib['name']] = child.attrib
+            elif child.tag == 'default':
+                self.default.update(child.attrib)
+            elif child.tag == 'project':
+                self.projects.append(child.attrib)
+            elif child.tag == 'remove-project':
+                name = child.attrib.get('name')
+                path = child.attrib.get('path')
+                self.projects = [
+                    p for p in self.projects
+                    if not ((name is None or p['name'] == name) and
+                            (path is None or
+                             p.get('path', p['name']) == path))]
+
+    def resolve(self):
+        """Projects with defaults applied."""
+        projects = []
+        for attrib in self.projects:
+            remote = attrib.get('remote', self.default.get('remote'))
+            revision = attrib.get('revision') or \
+                self.remotes.get(remote, {}).get('revision') or \
+                self.default.get('revision')
+            groups = [g for g in attrib.get('groups', '').replace(
+                ',', ' ').split() if g]
+            projects.append(Project(
+                attrib['name'],
+                os.path.normpath(attrib.get('path', attrib['name'])),
+                groups, revision, remote))
+        return projects
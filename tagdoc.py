@@ -14,13 +14,49 @@ import sys
 import re
 import subprocess
 import json
+import mmap
 import argparse
+import copy
 import datetime
-import xml.etree.ElementTree as ET
-
+import fnmatch
+import functools
+import hashlib
+import shutil
+import signal
+import sqlite3
+import StringIO
+import tempfile
+import threading
+import time
+import multiprocessing
+
+import utils
+from manifest import Manifest
 from utils import logger
 
-COMMENT_PATTERN = re.compile(r'''/\*(?P<body>.*?)\*/''', re.DOTALL)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+TOKEN_PATTERN = re.compile(r'''/[/*]|["']''')
+"""Tokens that change lexer state: comment openers and quotes."""
+
+LITERAL_PATTERNS = {
+    '"': re.compile(r'"(?:[^"\\\n]|\\.)*"?', re.DOTALL),
+    "'": re.compile(r"'(?:[^'\\\n]|\\.)*'?", re.DOTALL),
+}
+"""String and char literals. Unterminated ones end at the line end."""
+
+PHONELAB_MARKER = 'PhoneLab'
 
 PHONELAB_DOC_PATTERN = re.compile(r'''PhoneLab.*?(?P<json>\{.*\})''',
                                   re.DOTALL)
@@ -30,22 +66,56 @@ DEFAULT_AOSP_BASE = 'cm-13.0'
 DEFAULT_AOSP_ROOT = os.getcwd()
 DEFAULT_OUT_FILE = os.path.join(os.getcwd(), 'tagdoc.rst')
 DEFAULT_FORMAT = 'rst'
+DEFAULT_JOBS = 1
+DEFAULT_CACHE_SIZE = 64
+DEFAULT_IGNORE = ['.git', '.repo', '/out']
+DEFAULT_METADATA_JOBS = 16
+DEFAULT_TIMING_REPORT = 10
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_POLL_INTERVAL = 5.0
+
+REQUIRED_FIELDS = ['Category', 'Tag', 'Action']
+"""Tag doc fields that ``--validate`` rejects when empty."""
 
 HTTP_SERVER = 'http://platform.phone-lab.org:8080'
 
 
 class RepoProject(object):
 
-    def __init__(self, root, path, name):
+    def __init__(self, root, path, name, load=True):
         self.root = root
         self.path = path
         self.name = name
 
-        cwd = os.getcwd()
-        os.chdir(os.path.join(self.root, self.path))
-        self.current_branch = subprocess.check_output(
-            'git rev-parse --abbrev-ref HEAD', shell=True).strip().strip('\n')
-        os.chdir(cwd)
+        self.current_branch = None
+        self.head = None
+        self._dirty = None
+        if load:
+            self.load()
+
+    def load(self):
+        """Resolve current branch and HEAD commit.
+
+        Reads ``HEAD`` and refs from the git dir directly, and only falls
+        back to ``git rev-parse`` when that does not work out (e.g. unusual
+        git dir layout). A detached HEAD is reported as branch ``HEAD``, the
+        same as ``git rev-parse --abbrev-ref HEAD``.
+        """
+        head = read_git_head(self.abs_path)
+        if head is None:
+            out = utils.run(['git', 'rev-parse', 'HEAD', '--abbrev-ref',
+                             'HEAD'], cwd=self.abs_path).check().output.split()
+            head = (out[1], out[0])
+        self.current_branch, self.head = head
+
+    @property
+    def dirty(self):
+        """Whether the worktree has uncommitted or untracked changes."""
+        if self._dirty is None:
+            self._dirty = utils.run(['git', 'status', '--porcelain'],
+                                    cwd=self.abs_path
+                                    ).check().output.strip() != ''
+        return self._dirty
 
     @property
     def url(self):
@@ -68,17 +138,40 @@ class RepoProject(object):
 
     @classmethod
     def create_from_dir(self, repo_root):
-        projs = []
-        for child in ET.parse(os.path.join(repo_root, '.repo', 'manifests',
-                                           'default.xml')).getroot():
-            if child.tag == 'project' and 'notdefault' not in child.attrib.get(
-                    'groups', ''):
-                if 'path' in child.attrib:
-                    projs.append(RepoProject(repo_root, child.attrib['path'],
-                                             child.attrib['name']))
-                else:
-                    projs.append(RepoProject(repo_root, child.attrib['name'],
-                                             child.attrib['name']))
+        return RepoProject.load_all(repo_root)
+
+    @classmethod
+    def load_all(cls, repo_root, jobs=DEFAULT_METADATA_JOBS,
+                 check_dirty=False, groups=None):
+        """Create all projects in the manifest, with metadata loaded.
+
+        Metadata of projects is resolved ``jobs`` projects at a time, with no
+        ``os.chdir``.
+
+        Args:
+            repo_root (str): repo root directory.
+            jobs (int): number of threads.
+            check_dirty (bool): also resolve :attr:`dirty`, which needs a
+                ``git status`` in each project.
+            groups (list): manifest groups to select, see
+                :meth:`manifest.Manifest.projects`.
+
+        Returns:
+            list: :class:`RepoProject` objects, in manifest order.
+        """
+        projs = [cls(repo_root, p.path, p.name, load=False) for p in
+                 Manifest.load(repo_root).projects(groups)]
+
+        def load(proj):
+            proj.load()
+            if check_dirty:
+                proj.dirty
+
+        runner = utils.Runner(min(jobs, len(projs)))
+        try:
+            runner.map(load, projs)
+        finally:
+            runner.close()
 
         return projs
 
@@ -86,6 +179,63 @@ class RepoProject(object):
         return self.name
 
 
+def read_git_head(path):
+    """Read current branch and HEAD commit of a git project from disk.
+
+    Handles both ``.git`` dirs (including repo's symlinked layout) and
+    ``.git`` files pointing to a separate git dir, loose and packed refs.
+
+    Args:
+        path (str): project worktree directory.
+
+    Returns:
+        tuple: ``(branch, sha)``, or ``None`` if it can not be resolved.
+    """
+    git_dir = os.path.join(path, '.git')
+    try:
+        if os.path.isfile(git_dir):
+            with open(git_dir, 'r') as f:
+                line = f.read().strip()
+            if not line.startswith('gitdir:'):
+                return None
+            git_dir = os.path.join(path, line[len('gitdir:'):].strip())
+
+        common_dir = git_dir
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir'), 'r') as f:
+                common_dir = os.path.join(git_dir, f.read().strip())
+
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+    except (IOError, OSError):
+        return None
+
+    if not head.startswith('ref:'):
+        return ('HEAD', head)
+
+    ref = head[len('ref:'):].strip()
+    branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') \
+        else ref
+
+    for d in [git_dir, common_dir]:
+        try:
+            with open(os.path.join(d, ref), 'r') as f:
+                return (branch, f.read().strip())
+        except (IOError, OSError):
+            pass
+
+    try:
+        with open(os.path.join(common_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return (branch, parts[0])
+    except (IOError, OSError):
+        pass
+
+    return None
+
+
 class TagDoc(object):
 
     FIELD_MAPPING = {
@@ -110,147 +260,1574 @@ class TagDoc(object):
         self.institution = self.tag.split('-')[-1]
 
     @classmethod
-    def create_from_file(cls, proj, src_file):
-        filename, extention = os.path.splitext(src_file)
-        if extention not in cls.SRC_EXTENSIONS:
-            return []
+    def create_from_file(cls, proj, src_file, cache=None):
+        return [TagDoc(doc, proj, src_file, line_no)
+                for doc, line_no in scan_files([src_file], cache=cache)[0]]
+
+    @classmethod
+    def create_from_proj(cls, proj, cache=None, walker=None):
+        return cls.create_from_projs([proj], cache=cache, walker=walker)
+
+    @classmethod
+    def create_from_projs(cls, projs, jobs=1, cache=None, walker=None):
+        """Collect tag docs from multiple projects.
+
+        With ``jobs > 1``, file listing (per project) and parsing (per file)
+        are spread over a process pool. Workers only return ``(doc, line_no)``
+        records, which are turned into :class:`TagDoc` objects here in project
+        and file order, so the result is the same as a serial run. Time spent
+        on each project by the workers is traced, see
+        :func:`add_project_span`.
+
+        Args:
+            projs (list): :class:`RepoProject` objects to scan.
+            jobs (int): number of worker processes.
+            cache (TagCache): parsed records cache, or ``None``.
+            walker (SourceWalker): walker to list files, or ``None``.
+
+        Returns:
+            list: :class:`TagDoc` objects.
+        """
+        walker = walker or SourceWalker()
+        file_lists = []
+        with utils.span('list_source_files', projects=len(projs)):
+            walks, walk_timings = pool_map_timed(
+                walk_project, [(walker, proj.abs_path) for proj in projs],
+                jobs)
+        for src_files, stats in walks:
+            file_lists.append(src_files)
+            walker.add_stats(stats)
+        all_files = [f for src_files in file_lists for f in src_files]
+        scan_timings = []
+        with utils.span('scan_files', files=len(all_files)):
+            results = scan_files(all_files, jobs, cache, scan_timings)
 
         tag_docs = []
+        pos = 0
+        for proj, src_files, walk_timing in zip(projs, file_lists,
+                                                walk_timings):
+            end = pos + len(src_files)
+            count = 0
+            for src_file, records in zip(src_files, results[pos:end]):
+                for doc, line_no in records:
+                    tag_docs.append(TagDoc(doc, proj, src_file, line_no))
+                count += len(records)
+            add_project_span(proj, [
+                ('list_source_files', [walk_timing]),
+                ('scan_files', [t for ts in scan_timings[pos:end]
+                                for t in ts])], files=len(src_files))
+            pos = end
+            logger.info("%d tags found in project %s." % (count, proj.path))
 
-        with open(src_file, 'r') as f:
-            s = f.read()
-            for comment in COMMENT_PATTERN.finditer(s):
-                match = PHONELAB_DOC_PATTERN.search(comment.group('body'))
-                if match is None:
-                    continue
-                try:
-                    text = ' '.join([l.strip() for l in match.group(
-                        'json').replace('*', '').splitlines()])
-                    doc = json.loads(text)
-                    tag_docs.append(TagDoc(doc, proj, src_file,
-                                           s.count('\n', 0, comment.start()) + 1))
-                except:
-                    logger.exception("Invalid doc string in file %s: %s" %
-                                     (src_file, match.group('json')))
-                    logger.info("JSON Text: %s" % (text))
-                    continue
+        return tag_docs
+
+    @classmethod
+    def create_incremental(cls, projs, develop_branch, index, jobs=1,
+                           cache=None, walker=None):
+        """Collect tag docs, only parsing files changed against develop.
+
+        Records of files that are identical to ``develop_branch`` are carried
+        over from ``index`` as long as the develop branch has not moved since
+        the previous run. Files left out of the index last time are parsed
+        again, even if they are now back to develop. Otherwise the whole
+        project is parsed once to rebuild its index entry. Projects where
+        develop does not resolve are always parsed in full, and get no index
+        entry. ``index`` is updated in place.
+
+        Args:
+            projs (list): :class:`RepoProject` objects to scan.
+            develop_branch (str): branch to diff against.
+            index (TagIndex): records from the previous run.
+            jobs (int): number of worker processes.
+            cache (TagCache): parsed records cache, or ``None``.
+            walker (SourceWalker): walker to list files, or ``None``.
+
+        Returns:
+            list: :class:`TagDoc` objects.
+        """
+        walker = walker or SourceWalker()
+        plans = []
+        tasks = []
+        for proj in projs:
+            start = time.time()
+            result = utils.run(['git', 'rev-parse', '-q', '--verify',
+                                '%s^{commit}' % (develop_branch)],
+                               cwd=proj.abs_path)
+            base = result.output.strip() if result.ok else None
+            changed = set()
+            if base is not None:
+                changed = changed_source_files(proj, develop_branch,
+                                               walker)
+            entry = index.get(proj.path)
+            if base is not None and entry is not None and \
+                    entry['base'] == base and 'left_out' in entry:
+                # Files reverted to develop since last run are not in the
+                # index either, parse them again too. Ignore patterns may
+                # have changed since the index was written.
+                stale = changed | set(f for f in entry['left_out']
+                                      if not walker.skips(proj.path, f))
+                carried = dict((f, records) for f, records in
+                               entry['files'].items()
+                               if f not in stale and
+                               not walker.skips(proj.path, f))
+                to_parse = sorted(f for f in stale if os.path.isfile(
+                    os.path.join(proj.abs_path, f)))
+                logger.info("Parsing %d changed files in project %s" %
+                            (len(to_parse), proj.path))
+            else:
+                carried = {}
+                to_parse = [os.path.relpath(f, proj.abs_path)
+                            for f in list_source_files(proj.abs_path, walker)]
+                logger.info("Parsing project %s (%s)" % (
+                    proj.path, "no usable index" if base is not None else
+                    "no develop branch"))
+            list_timing = (os.getpid(), start, time.time() - start)
+            plans.append((proj, base, changed, carried, list_timing))
+            tasks.extend((proj, f) for f in to_parse)
+
+        scan_timings = []
+        results = scan_files([os.path.join(proj.abs_path, f)
+                              for proj, f in tasks], jobs, cache,
+                             scan_timings)
+        parsed = dict((proj.path, {}) for proj in projs)
+        proj_timings = dict((proj.path, []) for proj in projs)
+        for (proj, f), records, timings in zip(tasks, results, scan_timings):
+            parsed[proj.path][f] = records
+            proj_timings[proj.path].extend(timings)
+
+        tag_docs = []
+        for proj, base, changed, carried, list_timing in plans:
+            records_by_file = dict(carried)
+            records_by_file.update(parsed[proj.path])
+            if base is not None:
+                index.set(proj.path, base, dict(
+                    (f, records) for f, records in records_by_file.items()
+                    if records and f not in changed), changed)
+
+            count = 0
+            for f in sorted(records_by_file, key=walk_order_key):
+                for doc, line_no in records_by_file[f]:
+                    tag_docs.append(TagDoc(doc, proj,
+                                           os.path.join(proj.abs_path, f),
+                                           line_no))
+                    count += 1
+            add_project_span(proj, [
+                ('list_changed_files', [list_timing]),
+                ('scan_files', proj_timings[proj.path])],
+                files=len(parsed[proj.path]))
+            logger.info("%d tags found in project %s." % (count, proj.path))
 
         return tag_docs
 
+
     @classmethod
-    def create_from_proj(cls, proj):
+    def create_from_ref(cls, projs, ref, jobs=1, cache=None):
+        """Collect tag docs from a git ref without reading the worktree.
+
+        Blobs are listed with ``git ls-tree`` and read from the object store,
+        so any branch can be documented without checking it out. Listing
+        runs on a :class:`utils.Runner`, blob parsing is spread over ``jobs``
+        processes, and blob SHAs double as cache keys.
+
+        Args:
+            projs (list): :class:`RepoProject` objects to scan.
+            ref (str): git ref to scan in each project.
+            jobs (int): number of worker processes.
+            cache (TagCache): parsed records cache, or ``None``.
+
+        Returns:
+            list: :class:`TagDoc` objects.
+        """
+        runner = utils.Runner(min(DEFAULT_METADATA_JOBS, len(projs)))
+        try:
+            listed = runner.map(timed_call, [(list_tree_blobs,
+                                              (proj.abs_path, ref))
+                                             for proj in projs])
+        finally:
+            runner.close()
+        blob_lists = [blobs for blobs, timing in listed]
+
+        records_by_sha = {}
+        if cache is not None:
+            records_by_sha = cache.get_many(
+                [sha for blobs in blob_lists for path, sha in blobs])
+
+        tasks = []
+        for proj, blobs in zip(projs, blob_lists):
+            misses = []
+            seen = set()
+            for path, sha in blobs:
+                if sha not in records_by_sha and sha not in seen:
+                    misses.append((path, sha))
+                    seen.add(sha)
+            tasks.append((proj.abs_path, misses))
+
+        new_records = {}
+        blob_results, scan_timings = pool_map_timed(scan_blobs, tasks, jobs)
+        for (git_dir, misses), results in zip(tasks, blob_results):
+            for (path, sha), records in zip(misses, results):
+                new_records[sha] = records
+        if cache is not None:
+            cache.put_many(new_records)
+        records_by_sha.update(new_records)
+
         tag_docs = []
-        for dirpath, dirnames, filenames in os.walk(proj.abs_path):
-            for f in filenames:
-                tag_docs.extend(cls.create_from_file(
-                    proj, os.path.join(dirpath, f)))
+        for proj, blobs, (_, list_timing), scan_timing, (_, misses) in zip(
+                projs, blob_lists, listed, scan_timings, tasks):
+            count = 0
+            for path, sha in blobs:
+                for doc, line_no in records_by_sha[sha]:
+                    tag_docs.append(TagDoc(
+                        doc, proj, os.path.join(proj.abs_path, path),
+                        line_no))
+                    count += 1
+            add_project_span(proj, [('list_tree_blobs', [list_timing]),
+                                    ('scan_blobs', [scan_timing])],
+                             files=len(blobs), parsed=len(misses))
+            logger.info("%d tags found in project %s." % (count, proj.path))
 
         return tag_docs
 
 
-class HTMLFormatter(object):
+class TagIndex(object):
+    """Tag records from the previous run, for incremental scanning.
 
-    def __init__(self, tag_docs):
-        self.tag_docs = tag_docs
+    Only files identical to the develop branch are recorded, keyed by project
+    path and then file path relative to the project, along with the develop
+    commit they were parsed against and the files left out because they
+    differed from it.
+    """
 
-    def __repr__(self):
-        body = ''
-
-        for category in sorted(list(set([t.category for t in self.tag_docs]))):
-            body += '<h2><b>Category</b>: %s</h2>\n' % (category)
-            category_tags = [
-                t for t in self.tag_docs if t.category == category]
-            for tag in sorted(list(set([t.tag for t in category_tags]))):
-                body += '<h4><b>Tag</b>: <code>%s</code></h4>\n' % (tag)
-                body += '<ol>\n'
-                for tag in sorted([t for t in category_tags if t.tag == tag], key=lambda t: t.action):
-                    body += '<li style="margin-bottom: 10px;">\n'
-                    body += '<b>Action</b>: <code>%s</code></br>\n' % (
-                        tag.action)
-                    body += '<b>File</b>: <code><a href="%s" target="_blanck"><b>%s</b></a>/<a href="%s" target="_blank">%s:%d</a></code></br>\n'\
-                        % (tag.proj.url, tag.proj.path, tag.proj.get_file_url(tag.file, tag.line_no), tag.proj.get_relative_path(tag.file), tag.line_no)
-                    body += '<b>Description</b>: %s</br>\n' % (tag.description)
-                    body += '</li>\n'
-                body += '</ol>\n'
-
-        tags = set([t.tag for t in self.tag_docs])
-        actions = set([t.action for t in self.tag_docs])
-        categories = set([t.category for t in self.tag_docs])
-        institutions = set([t.institution for t in self.tag_docs])
-
-        summary = '<h2>Summary</h2>\n'
-        summary += "<p>PhoneLab's instrumented Android platform currently contains:</p>\n"
-        summary += '<ul>\n'
-        summary += '<li><b>%d</b> tags, <b>%d</b> actions,</li>\n' % (
-            len(tags), len(actions))
-        summary += '<li>... in <b>%d</b> categories,</li>\n' % (
-            len(categories))
-        summary += '<li>... added by <b>%d</b> institution%s.</li>\n' % (
-            len(institutions), 's' if len(institutions) > 1 else '')
-        summary += '</ul>\n'
-
-        footer = '<hr>\n'
-        footer += '<p><i>Last updated %s.</i></p>' % (datetime.date.today())
-
-        return summary + body + footer
-
-
-class RSTFormatter(object):
+    def __init__(self, path):
+        self.path = path
+        self.projects = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.projects = json.load(f)
+            except ValueError:
+                logger.warn("Ignoring corrupted tag index %s" % (path))
+
+    def get(self, proj_path):
+        return self.projects.get(proj_path)
+
+    def set(self, proj_path, base, files, left_out):
+        self.projects[proj_path] = {'base': base, 'files': files,
+                                    'left_out': sorted(left_out)}
+
+    def save(self):
+        tmp = '%s.tmp' % (self.path)
+        with open(tmp, 'w') as f:
+            json.dump(self.projects, f)
+        os.rename(tmp, self.path)
+
+
+class TagCache(object):
+    """On-disk cache of parsed tag records, keyed by git blob SHA.
+
+    Backed by a SQLite file. Entries are evicted least recently used first
+    once the stored records exceed ``max_bytes``. The cache is dropped when
+    :attr:`VERSION` changes, so bump it whenever the parser output changes.
+    """
+
+    VERSION = 2
+
+    QUERY_BATCH = 500
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_SIZE * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                          '(key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS records '
+                          '(sha TEXT PRIMARY KEY, records TEXT, '
+                          'size INTEGER, last_used REAL)')
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(self.VERSION):
+            self.conn.execute('DELETE FROM records')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES "
+                              "('version', ?)", (str(self.VERSION),))
+        self.conn.commit()
+
+    def get_many(self, shas):
+        """Look up records of blobs.
+
+        Returns:
+            dict: blob SHA to records, only for blobs found in the cache.
+        """
+        found = {}
+        shas = list(set(shas))
+        for i in range(0, len(shas), self.QUERY_BATCH):
+            batch = shas[i:i + self.QUERY_BATCH]
+            for sha, records in self.conn.execute(
+                    'SELECT sha, records FROM records WHERE sha IN (%s)' %
+                    (','.join('?' * len(batch))), batch):
+                found[sha] = json.loads(records)
+
+        now = time.time()
+        self.conn.executemany('UPDATE records SET last_used = ? WHERE sha = ?',
+                              [(now, sha) for sha in found])
+        self.conn.commit()
+        self.hits += len(found)
+        self.misses += len(shas) - len(found)
+        return found
+
+    def put_many(self, records_by_sha):
+        now = time.time()
+        rows = []
+        for sha, records in records_by_sha.items():
+            text = json.dumps(records)
+            rows.append((sha, text, len(sha) + len(text), now))
+        self.conn.executemany('INSERT OR REPLACE INTO records '
+                              'VALUES (?, ?, ?, ?)', rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM records').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        stale = []
+        for sha, size in self.conn.execute(
+                'SELECT sha, size FROM records ORDER BY last_used'):
+            if total <= self.max_bytes:
+                break
+            stale.append((sha,))
+            total -= size
+        self.conn.executemany('DELETE FROM records WHERE sha = ?', stale)
+        self.conn.commit()
+        logger.debug("Evicted %d entries from tag cache." % (len(stale)))
+
+    def close(self):
+        logger.info("Tag cache: %d hits, %d misses." %
+                    (self.hits, self.misses))
+        self.conn.close()
+
+
+def pool_map(func, items, jobs):
+    """Order-preserving ``map`` over a pool of ``jobs`` processes.
+
+    Falls back to a plain ``map`` for ``jobs <= 1``.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(func, items, max(1, len(items) // (jobs * 4)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def pool_map_timed(func, items, jobs):
+    """:func:`pool_map` that also reports how long each item took.
+
+    Returns:
+        tuple: ``(results, timings)``, see :func:`timed_call`.
+    """
+    pairs = pool_map(timed_call, [(func, item) for item in items], jobs)
+    return [r for r, t in pairs], [t for r, t in pairs]
+
+
+def timed_call(task):
+    """Run ``func(arg)`` for a ``(func, arg)`` task, timing it.
+
+    Module level, so that it can be dispatched to worker processes.
+
+    Returns:
+        tuple: ``(result, (pid, start, duration))``.
+    """
+    func, arg = task
+    start = time.time()
+    result = func(arg)
+    return result, (os.getpid(), start, time.time() - start)
+
+
+def add_project_span(proj, stages, **args):
+    """Trace the time spent on one project, possibly by pool workers.
+
+    The duration of the ``project`` span and of each stage span is the summed
+    duration of their calls, so pooled projects compare by the work they
+    took. Spans start at the first call, and ``wall`` is the time from the
+    first call to the end of the last one. Work of one worker process shows
+    on its own row in the trace viewer.
+
+    Args:
+        proj (RepoProject): the project.
+        stages (list): ``(name, timings)`` tuples, see :func:`timed_call`.
+        args: extra details of the project span.
+    """
+    def add(name, timings, parent=None, **args):
+        start = min(t[1] for t in timings)
+        pids = set(t[0] for t in timings)
+        return utils.add_span(
+            name, start, sum(t[2] for t in timings), parent=parent,
+            tid=pids.pop() if len(pids) == 1 else None,
+            wall='%.3fs' % (max(t[1] + t[2] for t in timings) - start),
+            **args)
+
+    timings = [t for name, stage_timings in stages for t in stage_timings]
+    if len(timings) == 0:
+        return
+    parent = add('project', timings, proj=proj.path, **args)
+    for name, stage_timings in stages:
+        if len(stage_timings) > 0:
+            add(name, stage_timings, parent)
+
+
+def scan_files(src_files, jobs=1, cache=None, timings=None):
+    """Parse tag docs from many files, going through ``cache`` if given.
+
+    Only files with :data:`PHONELAB_MARKER` are looked up in the cache, the
+    others have no tag docs and are not read past the marker search.
+
+    Args:
+        src_files (list): source file paths.
+        jobs (int): number of worker processes.
+        cache (TagCache): parsed records cache, or ``None``.
+        timings (list): if given, extended with a list of worker timings of
+            each file, see :func:`timed_call`.
+
+    Returns:
+        list: records of each file, see :func:`scan_file`.
+    """
+    if cache is None:
+        results, file_timings = pool_map_timed(scan_file, src_files, jobs)
+        if timings is not None:
+            timings.extend([t] for t in file_timings)
+        return results
+
+    shas, sha_timings = pool_map_timed(marked_blob_sha, src_files, jobs)
+    records_by_sha = cache.get_many([sha for sha in shas if sha is not None])
+    misses = [i for i, sha in enumerate(shas)
+              if sha is not None and sha not in records_by_sha]
+    parsed, parse_timings = pool_map_timed(
+        scan_file, [src_files[i] for i in misses], jobs)
+    if timings is not None:
+        file_timings = [[t] for t in sha_timings]
+        for i, t in zip(misses, parse_timings):
+            file_timings[i].append(t)
+        timings.extend(file_timings)
+
+    new_records = {}
+    for i, records in zip(misses, parsed):
+        new_records[shas[i]] = records
+    cache.put_many(new_records)
+
+    records_by_sha.update(new_records)
+    return [records_by_sha[sha] if sha is not None else [] for sha in shas]
+
+
+def marked_blob_sha(path):
+    """Git blob SHA of a source file, same as ``git hash-object``.
+
+    Returns:
+        str: the SHA, or ``None`` if the file can not have tag docs: not a
+        source file, or no :data:`PHONELAB_MARKER` in it.
+    """
+    if os.path.splitext(path)[1] not in TagDoc.SRC_EXTENSIONS:
+        return None
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if m.find(PHONELAB_MARKER) == -1:
+                return None
+            return hashlib.sha1('blob %d\0' % (size) + m[:]).hexdigest()
+        finally:
+            m.close()
+
+
+def walk_order_key(rel_path):
+    """Sort key that orders relative paths like :func:`list_source_files`."""
+    dirname, filename = os.path.split(rel_path)
+    return (tuple(dirname.split(os.sep)), filename)
+
+
+def changed_source_files(proj, develop_branch, walker=None):
+    """Source files in a project that differ from the develop branch.
+
+    Includes modified, added, deleted and untracked files, even the ones git
+    ignores, since a full scan reads them too. Renames are reported as a
+    delete plus an add.
+
+    Args:
+        proj (RepoProject): project to diff.
+        develop_branch (str): branch to diff against.
+        walker (SourceWalker): leave out files this walker skips, or
+            ``None``.
+
+    Returns:
+        set: file paths relative to the project root.
+    """
+    pathspec = ['*%s' % (ext) for ext in TagDoc.SRC_EXTENSIONS]
+    diff = utils.run(['git', 'diff', '--name-only', '--no-renames',
+                      develop_branch, '--'] + pathspec,
+                     cwd=proj.abs_path).check()
+    others = utils.run(['git', 'ls-files', '--others', '--'] + pathspec,
+                       cwd=proj.abs_path).check()
+    return set(l for l in (diff.output + others.output).splitlines()
+               if l and (walker is None or not walker.skips(proj.path, l)))
+
+
+class SourceWalker(object):
+    """Directory walker that only yields source files with tag docs.
+
+    Ignored directories and nested manifest projects are pruned before
+    descending, and file names are filtered by extension before any path is
+    built. Entries are visited in name order, files before sub-directories.
+
+    Ignore patterns are shell globs. Patterns containing ``/`` are matched
+    against the path relative to ``root`` (a leading ``/`` is stripped);
+    others are matched against the entry name.
+
+    Args:
+        root (str): repo root directory.
+        project_paths (list): manifest project paths, relative to ``root``.
+        ignore (list): ignore patterns.
+    """
+
+    def __init__(self, root=None, project_paths=(), ignore=DEFAULT_IGNORE):
+        self.root = root
+        self.project_paths = set(project_paths)
+        self.name_patterns = [p for p in ignore if '/' not in p]
+        self.path_patterns = [p.lstrip('/') for p in ignore if '/' in p]
+
+        self.dirs = 0
+        self.files = 0
+        self.src_files = 0
+        self.bytes = 0
+
+    def ignored(self, name, rel_path):
+        return any(fnmatch.fnmatch(name, p) for p in self.name_patterns) or \
+            (rel_path is not None and
+             any(fnmatch.fnmatch(rel_path, p) for p in self.path_patterns))
+
+    def skips(self, proj_path, rel_path):
+        """Whether walking a project skips one of its paths.
+
+        Args:
+            proj_path (str): project path, relative to ``root``.
+            rel_path (str): path relative to the project.
+
+        Returns:
+            bool: ``True`` if the path or one of its parent dirs is ignored.
+        """
+        path = proj_path if self.root is not None else None
+        for name in rel_path.split('/'):
+            if name in ('', '.'):
+                continue
+            if path is not None:
+                path = '%s/%s' % (path, name)
+            if self.ignored(name, path):
+                return True
+        return False
+
+    def walk(self, path):
+        """List source files under ``path``.
+
+        Returns:
+            list: absolute file paths.
+        """
+        rel_path = None
+        if self.root is not None:
+            rel_path = os.path.relpath(path, self.root)
+        src_files = []
+        self._walk(path, rel_path, src_files)
+        return src_files
+
+    def _walk(self, path, rel_path, src_files):
+        self.dirs += 1
+        subdirs = []
+        for name, is_dir, size in sorted(_list_dir(path)):
+            self.files += not is_dir
+            child_rel_path = None
+            if rel_path is not None:
+                child_rel_path = name if rel_path == '.' else \
+                    '%s/%s' % (rel_path, name)
+            if is_dir:
+                if child_rel_path not in self.project_paths and \
+                        not self.ignored(name, child_rel_path):
+                    subdirs.append((name, child_rel_path))
+            elif os.path.splitext(name)[1] in TagDoc.SRC_EXTENSIONS and \
+                    not self.ignored(name, child_rel_path):
+                size = size()
+                if size is not None:
+                    src_files.append(os.path.join(path, name))
+                    self.src_files += 1
+                    self.bytes += size
+
+        for name, child_rel_path in subdirs:
+            self._walk(os.path.join(path, name), child_rel_path, src_files)
+
+    @property
+    def stats(self):
+        return (self.dirs, self.files, self.src_files, self.bytes)
+
+    def add_stats(self, stats):
+        self.dirs += stats[0]
+        self.files += stats[1]
+        self.src_files += stats[2]
+        self.bytes += stats[3]
+
+    def report(self):
+        logger.info("Visited %d dirs and %d files, %d source files "
+                    "(%d bytes) matched." % self.stats)
+
+
+def _list_dir(path):
+    """List a directory as ``(name, is_dir, size)`` tuples.
+
+    ``size`` is a callable returning the size of a regular file, or ``None``
+    for anything else (e.g. broken symlinks). Symlinked directories are
+    reported as files so that they are not followed, like ``os.walk``.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            yield (entry.name, entry.is_dir(follow_symlinks=False),
+                   functools.partial(_entry_size, entry))
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            is_dir = os.path.isdir(full_path) and \
+                not os.path.islink(full_path)
+            yield (name, is_dir, functools.partial(_path_size, full_path))
+
+
+def _entry_size(entry):
+    try:
+        if entry.is_file():
+            return entry.stat().st_size
+    except OSError:
+        pass
+    return None
+
+
+def _path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return None
+
+
+def list_source_files(path, walker=None):
+    """List source files that may contain tag docs.
+
+    Args:
+        path (str): directory to walk.
+        walker (SourceWalker): walker to use, or ``None`` for a default one.
+
+    Returns:
+        list: file paths with one of :attr:`TagDoc.SRC_EXTENSIONS`, in
+        ``os.walk`` order with directories and files sorted by name.
+    """
+    return (walker or SourceWalker()).walk(path)
+
+
+def walk_project(task):
+    """Worker version of :func:`list_source_files`.
+
+    Args:
+        task (tuple): ``(walker, path)``.
+
+    Returns:
+        tuple: file paths, and the walker stats of this walk.
+    """
+    walker, path = task
+    walker = copy.copy(walker)
+    walker.dirs = walker.files = walker.src_files = walker.bytes = 0
+    return walker.walk(path), walker.stats
+
+
+def scan_file(src_file):
+    """Parse tag docs from a source file.
+
+    This is a module level function so that it can be dispatched to worker
+    processes.
+
+    Args:
+        src_file (str): source file path.
+
+    Returns:
+        list: ``(doc, line_no)`` tuples, in file order. Invalid docs are
+        logged and skipped.
+    """
+    filename, extention = os.path.splitext(src_file)
+    if extention not in TagDoc.SRC_EXTENSIONS:
+        return []
+
+    with open(src_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Most files have no tag docs at all, skip them without copying.
+            if m.find(PHONELAB_MARKER) == -1:
+                return []
+            return scan_text(m[:], src_file)
+        finally:
+            m.close()
+
+
+def scan_text(s, src_file, errors=None):
+    """Parse tag docs from source text.
+
+    ``s`` is lexed in a single pass: ``/* */`` comments are only recognized
+    in code, not inside string or char literals or ``//`` comments, and line
+    numbers are counted incrementally.
+
+    Args:
+        s (str): source file content.
+        src_file (str): file name, only used in log messages.
+        errors (list): if given, invalid docs are not logged but appended
+            here as ``(line_no, reason)`` tuples.
+
+    Returns:
+        list: ``(doc, line_no)`` tuples, see :func:`scan_file`.
+    """
+    records = []
+    if PHONELAB_MARKER not in s:
+        return records
+
+    pos = 0
+    line_no = 1
+    line_pos = 0
+    while True:
+        token = TOKEN_PATTERN.search(s, pos)
+        if token is None:
+            break
+
+        start = token.start()
+        kind = token.group()
+        if kind == '//':
+            pos = s.find('\n', start)
+            if pos == -1:
+                break
+            continue
+        elif kind != '/*':
+            pos = LITERAL_PATTERNS[kind].match(s, start).end()
+            continue
+
+        end = s.find('*/', start + 2)
+        if end == -1:
+            break
+        pos = end + 2
+
+        body = s[start + 2:end]
+        if PHONELAB_MARKER not in body:
+            continue
+        match = PHONELAB_DOC_PATTERN.search(body)
+        if match is None:
+            continue
+
+        line_no += s.count('\n', line_pos, start)
+        line_pos = start
+        text = ' '.join([l.strip() for l in match.group(
+            'json').replace('*', '').splitlines()])
+        try:
+            doc = json.loads(text)
+            # Validate required fields before handing the record back.
+            TagDoc(doc, None, src_file, line_no)
+            records.append((doc, line_no))
+        except:
+            if errors is not None:
+                errors.append((line_no, invalid_doc_reason(text)))
+                continue
+            logger.exception("Invalid doc string in file %s: %s" %
+                             (src_file, match.group('json')))
+            logger.info("JSON Text: %s" % (text))
+            continue
+
+    return records
+
+
+def invalid_doc_reason(text):
+    """Why the JSON text of a tag doc is rejected by :func:`scan_text`."""
+    try:
+        doc = json.loads(text)
+    except ValueError as e:
+        return "invalid JSON: %s" % (e)
+    if not isinstance(doc, dict):
+        return "not a JSON object"
+    missing = sorted(set(TagDoc.FIELD_MAPPING.values()) - set(doc))
+    if len(missing) > 0:
+        return "missing %s" % (', '.join(missing))
+    return "invalid field value"
+
+
+class GitBlobReader(object):
+    """Read blobs through a long-lived ``git cat-file --batch`` process.
+
+    Args:
+        git_dir (str): directory of the git project.
+    """
+
+    def __init__(self, git_dir):
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, cwd=git_dir)
+
+    def read(self, sha):
+        self.proc.stdin.write('%s\n' % (sha))
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise Exception("Can not read blob %s: %s" %
+                            (sha, ' '.join(header)))
+        data = self.proc.stdout.read(int(header[2]))
+        # Each object is followed by a LF.
+        self.proc.stdout.read(1)
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def list_tree_blobs(task):
+    """List source blobs of a git tree.
+
+    Args:
+        task (tuple): ``(git_dir, ref)``.
+
+    Returns:
+        list: ``(path, sha)`` tuples with paths relative to ``git_dir``, in
+        the same order as :func:`list_source_files`.
+    """
+    git_dir, ref = task
+    out = utils.run(['git', 'ls-tree', '-r', '-z', ref],
+                    cwd=git_dir).check().output
+    blobs = []
+    for entry in out.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        mode, obj_type, sha = info.split()
+        if obj_type == 'blob' and mode != '120000' and \
+                os.path.splitext(path)[1] in TagDoc.SRC_EXTENSIONS:
+            blobs.append((path, sha))
+    return sorted(blobs, key=lambda b: walk_order_key(b[0]))
+
+
+def scan_blobs(task):
+    """Parse tag docs from blobs of one git project.
+
+    All blobs are streamed through a single :class:`GitBlobReader`.
+
+    Args:
+        task (tuple): ``(git_dir, [(path, sha), ...])``.
+
+    Returns:
+        list: records of each blob, see :func:`scan_file`.
+    """
+    git_dir, blobs = task
+    reader = GitBlobReader(git_dir)
+    try:
+        return [scan_text(reader.read(sha), os.path.join(git_dir, path))
+                for path, sha in blobs]
+    finally:
+        reader.close()
+
+
+def is_changed(proj, develop_branch, ref=None):
+    """Whether a project differs from the develop branch.
+
+    Tree ids of develop and ``ref`` (``HEAD`` by default) are compared first,
+    which costs no more than reading two commits. For ``HEAD`` with the same
+    tree as develop, the worktree is then checked against ``HEAD``. A project
+    whose commits differ from develop but whose worktree changes happen to
+    revert that difference is still reported as changed.
+
+    Returns:
+        bool: ``True`` if changed, or if develop can not be resolved. A
+        project without ``ref`` is reported as unchanged, since there is
+        nothing to scan.
+    """
+    result = utils.run(['git', 'rev-parse', '%s^{tree}' % (develop_branch),
+                        '%s^{tree}' % (ref or 'HEAD')], cwd=proj.abs_path)
+    if not result.ok:
+        if ref is not None and not utils.run(
+                ['git', 'rev-parse', '-q', '--verify', '%s^{tree}' % (ref)],
+                cwd=proj.abs_path).ok:
+            logger.warn("Ignoring repo %s: no ref %s" % (proj, ref))
+            return False
+        return True
+
+    trees = result.output.split()
+    if trees[0] != trees[1]:
+        return True
+    if ref is not None:
+        return False
+    return not utils.run(['git', 'diff', '--quiet', 'HEAD'],
+                         cwd=proj.abs_path).ok
+
+
+def find_changed_projects(projs, develop_branch, ref=None,
+                          jobs=DEFAULT_METADATA_JOBS):
+    """Find projects that differ from the develop branch, concurrently.
+
+    Per-project timing is logged, slowest first.
+
+    Args:
+        projs (list): :class:`RepoProject` objects to check.
+        develop_branch (str): branch to compare against.
+        ref (str): ref to compare, or ``None`` for the checkout.
+        jobs (int): number of threads.
+
+    Returns:
+        list: changed projects, in the order of ``projs``.
+    """
+    def check(proj):
+        start = time.time()
+        changed = is_changed(proj, develop_branch, ref)
+        return changed, time.time() - start
+
+    start = time.time()
+    runner = utils.Runner(min(jobs, len(projs)))
+    try:
+        results = runner.map(check, projs)
+    finally:
+        runner.close()
+
+    changed_projs = []
+    for proj, (changed, duration) in zip(projs, results):
+        if changed:
+            changed_projs.append(proj)
+        else:
+            logger.debug("Ignoring repo %s: not changes" % (proj))
+
+    timings = sorted(zip(projs, results), key=lambda r: -r[1][1])
+    for proj, (changed, duration) in timings[:DEFAULT_TIMING_REPORT]:
+        logger.debug("Checked %s in %.3f sec." % (proj.path, duration))
+    logger.info("%d of %d projects changed, checked in %.3f sec." %
+                (len(changed_projs), len(projs), time.time() - start))
+
+    return changed_projs
+
+
+def resolves(proj, ref):
+    """Whether ``ref`` names a commit in a project."""
+    return utils.run(['git', 'rev-parse', '-q', '--verify',
+                      '%s^{commit}' % (ref)], cwd=proj.abs_path).ok
+
+
+def parse_changed_files(proj, develop_branch, ref=None, walker=None):
+    """Parse source files that differ from develop, collecting problems.
+
+    Files are not looked up in the parsed tag cache, which does not keep
+    invalid docs. If develop does not resolve, all source files are parsed.
+
+    Args:
+        proj (RepoProject): project to check.
+        develop_branch (str): branch to diff against.
+        ref (str): ref to check, or ``None`` for the checkout.
+        walker (SourceWalker): walker to list files, or ``None``.
+
+    Returns:
+        tuple: ``(files, records, problems)``. ``files`` is a set of absolute
+        paths of the changed files, including deleted ones, ``records`` a list of ``(src_file, doc,
+        line_no)`` tuples of valid docs, and ``problems`` a list of
+        ``(src_file, line_no, reason)`` tuples.
+    """
+    has_develop = resolves(proj, develop_branch)
+    if ref is not None:
+        new = dict(list_tree_blobs((proj.abs_path, ref)))
+        old = dict(list_tree_blobs((proj.abs_path, develop_branch))) \
+            if has_develop else {}
+        changed = sorted([f for f in set(new) | set(old)
+                          if new.get(f) != old.get(f)], key=walk_order_key)
+        paths = [os.path.join(proj.abs_path, f) for f in changed]
+        reader = GitBlobReader(proj.abs_path)
+        try:
+            sources = [(os.path.join(proj.abs_path, f), reader.read(new[f]))
+                       for f in changed if f in new]
+        finally:
+            reader.close()
+    else:
+        if has_develop:
+            paths = [os.path.join(proj.abs_path, f) for f in
+                     sorted(changed_source_files(proj, develop_branch,
+                                                 walker),
+                            key=walk_order_key)]
+        else:
+            paths = list_source_files(proj.abs_path, walker)
+        sources = []
+        for path in paths:
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    sources.append((path, f.read()))
+
+    records = []
+    problems = []
+    for path, text in sources:
+        errors = []
+        for doc, line_no in scan_text(text, path, errors):
+            records.append((path, doc, line_no))
+            empty = [k for k in REQUIRED_FIELDS if not doc[k]]
+            if len(empty) > 0:
+                problems.append((path, line_no, "empty %s" % (
+                    ', '.join(empty))))
+        problems.extend((path, line_no, reason) for line_no, reason in errors)
+    return set(paths), records, problems
+
+
+def validate(projs, changed_projs, develop_branch, ref=None, jobs=1,
+             cache=None, walker=None):
+    """Check tag docs changed against develop.
+
+    Only changed files are parsed for invalid docs (see
+    :func:`parse_changed_files`). Their (tag, action) pairs are then checked
+    against an in-memory index of all docs in the tree, where unchanged files
+    are read from develop, mostly out of ``cache``. Duplicates that only
+    involve unchanged files are not reported.
+
+    Args:
+        projs (list): all :class:`RepoProject` objects.
+        changed_projs (list): projects that differ from develop.
+        develop_branch (str): branch to diff against.
+        ref (str): ref to check, or ``None`` for the checkout.
+        jobs (int): number of worker processes.
+        cache (TagCache): parsed records cache, or ``None``.
+        walker (SourceWalker): walker to list files, or ``None``.
+
+    Returns:
+        list: ``(src_file, line_no, reason)`` tuples, sorted.
+    """
+    runner = utils.Runner(min(DEFAULT_METADATA_JOBS, len(projs)))
+    try:
+        results = runner.map(
+            lambda p: parse_changed_files(p, develop_branch, ref, walker),
+            changed_projs)
+        has_develop = runner.map(lambda p: resolves(p, develop_branch),
+                                 projs)
+    finally:
+        runner.close()
+
+    changed_files = set()
+    problems = []
+    tree = []
+    for proj, (files, records, proj_problems) in zip(changed_projs, results):
+        changed_files.update(files)
+        problems.extend(proj_problems)
+        tree.extend(records)
+        logger.info("Checked %d changed files in project %s." %
+                    (len(files), proj.path))
+
+    # Files not changed are the same as in develop, where most of them are
+    # found in the cache.
+    rest = TagDoc.create_from_ref(
+        [p for p, ok in zip(projs, has_develop) if ok], develop_branch,
+        jobs, cache)
+    tree.extend((t.file, {'Tag': t.tag, 'Action': t.action}, t.line_no)
+                for t in rest if t.file not in changed_files)
+
+    index = {}
+    for path, doc, line_no in tree:
+        index.setdefault((doc['Tag'], doc['Action']), []).append(
+            (path, line_no))
+    root = projs[0].root if len(projs) > 0 else ''
+    for (tag, action), places in index.items():
+        changed_places = sorted(p for p in places if p[0] in changed_files)
+        if len(places) < 2 or len(changed_places) == 0:
+            continue
+        # One problem per pair, at the first changed place.
+        path, line_no = changed_places[0]
+        also = ['%s:%d' % (os.path.relpath(p, root), l)
+                for p, l in sorted(places) if (p, l) != (path, line_no)]
+        problems.append((path, line_no,
+                         "duplicate tag %s action %s, also at %s" %
+                         (tag, action, ', '.join(also))))
+
+    return sorted(set(problems))
+
+
+class TagDocIndex(object):
+    """Tag docs grouped by category and tag.
+
+    Built in one pass over the tag docs. Categories and tags are iterated in
+    sorted order, and docs of a tag are sorted by action, keeping the scan
+    order for equal actions.
+    """
+
+    def __init__(self, tag_docs):
+        self.categories = {}
+        self.tags = set()
+        self.actions = set()
+        self.institutions = set()
+
+        for t in tag_docs:
+            self.categories.setdefault(t.category, {}).setdefault(
+                t.tag, []).append(t)
+            self.tags.add(t.tag)
+            self.actions.add(t.action)
+            self.institutions.add(t.institution)
+
+        for category_tags in self.categories.values():
+            for docs in category_tags.values():
+                docs.sort(key=lambda t: t.action)
+
+    def __iter__(self):
+        """Iterate ``(category, [(tag, docs), ...])`` tuples."""
+        for category in sorted(self.categories):
+            category_tags = self.categories[category]
+            yield category, [(tag, category_tags[tag])
+                             for tag in sorted(category_tags)]
+
+    def iter_docs(self):
+        for category, tags in self:
+            for tag, docs in tags:
+                for t in docs:
+                    yield t
+
+
+class Formatter(object):
+    """Base class of output formatters.
+
+    Subclasses implement :meth:`write`, which streams the output to a file
+    object section by section.
+    """
 
     def __init__(self, tag_docs):
         self.tag_docs = tag_docs
+        self.index = TagDocIndex(tag_docs)
+
+    def write(self, f):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        buf = StringIO.StringIO()
+        self.write(buf)
+        return buf.getvalue()
+
+
+class HTMLFormatter(Formatter):
+
+    def write(self, f):
+        index = self.index
+
+        f.write('<h2>Summary</h2>\n')
+        f.write("<p>PhoneLab's instrumented Android platform currently contains:</p>\n")
+        f.write('<ul>\n')
+        f.write('<li><b>%d</b> tags, <b>%d</b> actions,</li>\n' % (
+            len(index.tags), len(index.actions)))
+        f.write('<li>... in <b>%d</b> categories,</li>\n' % (
+            len(index.categories)))
+        f.write('<li>... added by <b>%d</b> institution%s.</li>\n' % (
+            len(index.institutions), 's' if len(index.institutions) > 1 else ''))
+        f.write('</ul>\n')
+
+        for category, tags in index:
+            f.write('<h2><b>Category</b>: %s</h2>\n' % (category))
+            for tag, docs in tags:
+                f.write('<h4><b>Tag</b>: <code>%s</code></h4>\n' % (tag))
+                f.write('<ol>\n')
+                for tag in docs:
+                    f.write('<li style="margin-bottom: 10px;">\n')
+                    f.write('<b>Action</b>: <code>%s</code></br>\n' % (
+                        tag.action))
+                    f.write('<b>File</b>: <code><a href="%s" target="_blanck"><b>%s</b></a>/<a href="%s" target="_blank">%s:%d</a></code></br>\n'
+                            % (tag.proj.url, tag.proj.path, tag.proj.get_file_url(tag.file, tag.line_no), tag.proj.get_relative_path(tag.file), tag.line_no))
+                    f.write('<b>Description</b>: %s</br>\n' % (tag.description))
+                    f.write('</li>\n')
+                f.write('</ol>\n')
+
+        f.write('<hr>\n')
+        f.write('<p><i>Last updated %s.</i></p>\n' % (datetime.date.today()))
+
+
+class RSTFormatter(Formatter):
 
     def wrap_title(self, title, level='='):
         return '%s\n%s\n' % (title, level * len(title))
 
-    def __repr__(self):
-        body = ''
-        for category in sorted(list(set([t.category for t in self.tag_docs]))):
-            body += '\n\n'
-            body += self.wrap_title('Catetory: %s' % (category), level='+')
-
-            category_tags = [
-                t for t in self.tag_docs if t.category == category]
-            for tag in sorted(list(set([t.tag for t in category_tags]))):
-                body += '\n\n'
-                body += self.wrap_title('Tag: ``%s``' % (tag), level='~')
-                body += '\n'
-                for tag in sorted([t for t in category_tags if t.tag == tag],
-                                  key=lambda t: t.action):
-                    body += '#. | **Action**: ``%s``\n' % (tag.action)
-                    body += '   | **Project**: `%s <%s>`_\n' % (tag.proj.path,
-                                                                tag.proj.url)
-                    body += '   | **File**: `%s:%d <%s>`_\n' %\
-                        (tag.proj.get_relative_path(tag.file), tag.line_no,
-                         tag.proj.get_file_url(tag.file, tag.line_no))
-                    body += '   | **Description**: %s\n\n' % (tag.description)
-
-        tags = set([t.tag for t in self.tag_docs])
-        actions = set([t.action for t in self.tag_docs])
-        categories = set([t.category for t in self.tag_docs])
-        institutions = set([t.institution for t in self.tag_docs])
-
-        summary = self.wrap_title('Summary', level='-')
-        summary += "PhoneLab's instrumented Android platform currently contains:\n\n"
-        summary += '* %d tags, %d actions,\n\n' % (len(tags), len(actions))
-        summary += '* ... in %d categories,\n\n' % (len(categories))
-        summary += '* ... added by %d institution%s.\n\n' % (len(institutions),
-                                                             's' if len(institutions) > 1 else '')
-
-        footer = 'Last updated %s' % (datetime.date.today())
-
-        header = '.. Generated by %s on %s, DO NOT MODIFY.\n\n' % (
-            os.path.basename(__file__), datetime.date.today())
-
-        return header + summary + body + footer
+    def write(self, f):
+        index = self.index
+
+        f.write('.. Generated by %s on %s, DO NOT MODIFY.\n\n' % (
+            os.path.basename(__file__), datetime.date.today()))
+
+        f.write(self.wrap_title('Summary', level='-'))
+        f.write("PhoneLab's instrumented Android platform currently contains:\n\n")
+        f.write('* %d tags, %d actions,\n\n' % (len(index.tags),
+                                                 len(index.actions)))
+        f.write('* ... in %d categories,\n\n' % (len(index.categories)))
+        f.write('* ... added by %d institution%s.\n\n' % (
+            len(index.institutions), 's' if len(index.institutions) > 1 else ''))
+
+        for category, tags in index:
+            f.write('\n\n')
+            f.write(self.wrap_title('Catetory: %s' % (category), level='+'))
+
+            for tag, docs in tags:
+                f.write('\n\n')
+                f.write(self.wrap_title('Tag: ``%s``' % (tag), level='~'))
+                f.write('\n')
+                for tag in docs:
+                    f.write('#. | **Action**: ``%s``\n' % (tag.action))
+                    f.write('   | **Project**: `%s <%s>`_\n' % (tag.proj.path,
+                                                                 tag.proj.url))
+                    f.write('   | **File**: `%s:%d <%s>`_\n' %
+                            (tag.proj.get_relative_path(tag.file), tag.line_no,
+                             tag.proj.get_file_url(tag.file, tag.line_no)))
+                    f.write('   | **Description**: %s\n\n' % (tag.description))
+
+        f.write('Last updated %s\n' % (datetime.date.today()))
+
+
+class JSONFormatter(Formatter):
+    """One JSON object per tag doc, in the same order as the other formats."""
+
+    @staticmethod
+    def to_dict(tag):
+        return {
+            'category': tag.category,
+            'sub_category': tag.sub_category,
+            'tag': tag.tag,
+            'action': tag.action,
+            'description': tag.description,
+            'institution': tag.institution,
+            'project': tag.proj.path,
+            'file': tag.proj.get_relative_path(tag.file),
+            'line_no': tag.line_no,
+            'url': tag.proj.get_file_url(tag.file, tag.line_no),
+        }
+
+    def write(self, f):
+        f.write('[')
+        sep = '\n'
+        for tag in self.index.iter_docs():
+            f.write(sep)
+            f.write(json.dumps(self.to_dict(tag), sort_keys=True))
+            sep = ',\n'
+        f.write('\n]\n')
+
+
+class SQLiteFormatter(Formatter):
+    """A SQLite database with a single ``tags`` table.
+
+    SQLite needs a real file, so the database is built in a temporary file
+    and then copied to the output.
+    """
+
+    COLUMNS = ['category', 'sub_category', 'tag', 'action', 'description',
+               'institution', 'project', 'file', 'line_no', 'url']
+
+    def write(self, f):
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(path)
+            conn.execute('CREATE TABLE tags (%s)' % (', '.join(self.COLUMNS)))
+            conn.executemany(
+                'INSERT INTO tags VALUES (%s)' %
+                (', '.join('?' * len(self.COLUMNS))),
+                ([JSONFormatter.to_dict(tag)[c] for c in self.COLUMNS]
+                 for tag in self.index.iter_docs()))
+            conn.commit()
+            conn.close()
+
+            with open(path, 'rb') as db:
+                shutil.copyfileobj(db, f)
+        finally:
+            os.remove(path)
 
 
 FORMATTER_MAPPING = {
     'html': HTMLFormatter,
     'rst': RSTFormatter,
+    'json': JSONFormatter,
+    'sqlite': SQLiteFormatter,
 }
 
 
+
+class TagWatcher(object):
+    """Keeps tag docs of the checkout in memory and the output up to date.
+
+    After a full scan, only files touched since the last update are parsed
+    again. Changes come from inotify if ``pyinotify`` is installed, or else
+    from polling file mtimes. Updates are batched: the output is rewritten
+    once no change has been seen for ``debounce`` seconds, by renaming a
+    complete temp file over it.
+
+    Args:
+        root (str): repo root directory.
+        projects (list): :class:`RepoProject` objects to watch.
+        develop_branch (str): only projects that differ from it are
+            documented, like a normal run.
+        walker (SourceWalker): walker with the ignore patterns to apply.
+        out (str): output file.
+        format (str): output format, see :data:`FORMATTER_MAPPING`.
+        cache (TagCache): parsed records cache for the full scan, or ``None``.
+        jobs (int): number of worker processes for the full scan.
+        debounce (float): seconds without changes before an update.
+        poll_interval (float): seconds between polls, or ``None`` to use
+            inotify when available.
+    """
+
+    def __init__(self, root, projects, develop_branch, walker, out, format,
+                 cache=None, jobs=1, debounce=DEFAULT_DEBOUNCE,
+                 poll_interval=None):
+        self.root = root
+        self.projects = projects
+        self.develop_branch = develop_branch
+        self.walker = walker
+        self.out = out
+        self.format = format
+        self.cache = cache
+        self.jobs = jobs
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+
+        self.manifest = Manifest.load(root)
+        self.by_path = dict((p.path, p) for p in projects)
+        self.changed = {}
+        self.records = dict((p.path, {}) for p in projects)
+
+        self.pending = set()
+        self.last_change = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def load(self, changed=None):
+        """Scan all projects.
+
+        Args:
+            changed (list): projects known to differ from develop, or
+                ``None`` to find them.
+        """
+        if changed is None:
+            changed = find_changed_projects(self.projects,
+                                            self.develop_branch)
+        self.changed = dict((p.path, p in changed) for p in self.projects)
+
+        file_lists = pool_map(walk_project, [(self.walker, p.abs_path)
+                                             for p in self.projects],
+                              self.jobs)
+        tasks = [(proj, src_file)
+                 for proj, (src_files, stats) in zip(self.projects,
+                                                     file_lists)
+                 for src_file in src_files]
+        for (proj, src_file), records in zip(
+                tasks, scan_files([t[1] for t in tasks], self.jobs,
+                                  self.cache)):
+            if records:
+                self.records[proj.path][
+                    os.path.relpath(src_file, proj.abs_path)] = records
+        logger.info("Watching %d files in %d projects." %
+                    (len(tasks), len(self.projects)))
+
+    def notify(self, path):
+        """Report a changed file or dir, from any thread."""
+        with self.lock:
+            self.pending.add(path)
+            self.last_change = time.time()
+        self.wakeup.set()
+
+    def owner(self, path):
+        """Project of ``path``, or ``None`` if the path is not scanned."""
+        proj = self.manifest.find(path)
+        if proj is None or proj.path not in self.by_path:
+            return None
+        if self.walker.skips(proj.path, os.path.relpath(
+                path, os.path.join(self.root, proj.path))):
+            return None
+        return self.by_path[proj.path]
+
+    def update(self, paths):
+        """Parse touched files again.
+
+        Args:
+            paths (iterable): changed, created or deleted files and dirs.
+
+        Returns:
+            int: number of files parsed.
+        """
+        to_parse = {}
+        touched = set()
+        for path in paths:
+            proj = self.owner(path)
+            if proj is None:
+                continue
+            touched.add(proj.path)
+            records = self.records[proj.path]
+            rel_path = os.path.relpath(path, proj.abs_path)
+
+            # Whatever was at this path is gone or replaced.
+            records.pop(rel_path, None)
+            prefix = rel_path + os.sep
+            for f in [f for f in records if f.startswith(prefix)]:
+                del records[f]
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                for src_file in self.walker.walk(path):
+                    to_parse[src_file] = proj
+            elif os.path.splitext(path)[1] in TagDoc.SRC_EXTENSIONS and \
+                    os.path.isfile(path):
+                to_parse[path] = proj
+
+        src_files = sorted(to_parse)
+        for src_file, records in zip(src_files, scan_files(src_files)):
+            proj = to_parse[src_file]
+            if records:
+                self.records[proj.path][
+                    os.path.relpath(src_file, proj.abs_path)] = records
+
+        for path in touched:
+            self.changed[path] = is_changed(self.by_path[path],
+                                            self.develop_branch)
+        return len(src_files)
+
+    def tag_docs(self):
+        """Current tag docs, in the order of a full scan."""
+        tag_docs = []
+        for proj in self.projects:
+            if not self.changed.get(proj.path):
+                continue
+            records = self.records[proj.path]
+            for f in sorted(records, key=walk_order_key):
+                for doc, line_no in records[f]:
+                    tag_docs.append(TagDoc(doc, proj,
+                                           os.path.join(proj.abs_path, f),
+                                           line_no))
+        return tag_docs
+
+    def write(self):
+        """Rewrite the output atomically."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.out),
+                                   prefix='.%s.' % (os.path.basename(
+                                       self.out)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                FORMATTER_MAPPING[self.format](self.tag_docs()).write(f)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.out)
+        except:
+            os.remove(tmp)
+            raise
+
+    def run(self):
+        """Watch and update until interrupted.
+
+        Errors while updating are logged, and the changes are retried.
+        """
+        if self.poll_interval is None and pyinotify is not None:
+            stop = self._watch_inotify()
+        else:
+            if self.poll_interval is None:
+                logger.info("pyinotify not installed, polling for changes.")
+            stop = self._watch_poll(self.poll_interval or
+                                    DEFAULT_POLL_INTERVAL)
+
+        try:
+            while True:
+                # A timeout keeps the main thread responsive to Ctrl-C.
+                if not self.wakeup.wait(1):
+                    continue
+                with self.lock:
+                    wait = self.last_change + self.debounce - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                    continue
+
+                with self.lock:
+                    paths = self.pending
+                    self.pending = set()
+                    self.wakeup.clear()
+                start = time.time()
+                try:
+                    count = self.update(paths)
+                    self.write()
+                except Exception:
+                    # E.g. a file deleted while read, or a failed write. Try
+                    # these paths again after the next debounce delay.
+                    logger.exception("Failed to update %s, retrying %d "
+                                     "changes." % (self.out, len(paths)))
+                    for path in paths:
+                        self.notify(path)
+                    continue
+                logger.info("Parsed %d files for %d changes, updated %s in "
+                            "%.3f sec." % (count, len(paths), self.out,
+                                           time.time() - start))
+        finally:
+            stop()
+
+    def _watch_inotify(self):
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
+            pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | \
+            pyinotify.IN_MOVED_TO
+
+        def handle(event):
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                logger.warn("Too many changes, rescanning all projects.")
+                for proj in self.projects:
+                    self.notify(proj.abs_path)
+            elif event.pathname:
+                self.notify(event.pathname)
+
+        def exclude_filter(proj):
+            # Skip ignored dirs, and nested projects, which have their own
+            # watches.
+            def excluded(path):
+                rel_path = os.path.relpath(path, self.root)
+                return self.owner(path) is None or (
+                    rel_path != proj.path and
+                    self.manifest.get(rel_path) is not None)
+            return excluded
+
+        for proj in self.projects:
+            wm.add_watch(proj.abs_path, mask, rec=True, auto_add=True,
+                         exclude_filter=exclude_filter(proj))
+        notifier = pyinotify.ThreadedNotifier(wm, default_proc_fun=handle)
+        notifier.daemon = True
+        notifier.start()
+        logger.info("Watching for changes with inotify.")
+        return notifier.stop
+
+    def _watch_poll(self, interval):
+        stopped = threading.Event()
+
+        def snapshot():
+            files = {}
+            for proj in self.projects:
+                for src_file in self.walker.walk(proj.abs_path):
+                    try:
+                        st = os.stat(src_file)
+                    except OSError:
+                        continue
+                    files[src_file] = (st.st_mtime, st.st_size)
+            return files
+
+        def poll():
+            files = snapshot()
+            while not stopped.wait(interval):
+                new_files = snapshot()
+                for path in set(files) | set(new_files):
+                    if files.get(path) != new_files.get(path):
+                        self.notify(path)
+                files = new_files
+
+        t = threading.Thread(target=poll, name='poll')
+        t.daemon = True
+        t.start()
+        logger.info("Polling for changes every %.1f sec." % (interval))
+        return stopped.set
+
+
 def arg_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -262,6 +1839,48 @@ def arg_parser():
                         help="AOSP base tag.")
     parser.add_argument('--format', default=DEFAULT_FORMAT,
                         choices=FORMATTER_MAPPING.keys(), help="Output format.")
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help="# of processes for parallel scanning.")
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help="Only parse files changed against develop branch, "
+                        "reuse the rest from previous run.")
+    parser.add_argument('--index', default=None,
+                        help="Tag index file for incremental mode. "
+                        "Default: <root>/.repo/tagdoc_index.json")
+    parser.add_argument('--ref', default=None,
+                        help="Scan this git ref from the object store instead "
+                        "of the checked out files.")
+    parser.add_argument('--develop', default=None,
+                        help="Develop branch to find changes against. "
+                        "Default: phonelab/<aosp>/develop")
+    parser.add_argument('--validate', action='store_true', default=False,
+                        help="Only check tag docs changed against develop: "
+                        "invalid docs, empty required fields and duplicate "
+                        "(tag, action) pairs. No output file is written, and "
+                        "the exit code is non-zero if there are problems.")
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help="Keep running, and update the output whenever "
+                        "source files change, only parsing the changed ones.")
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help="Seconds without changes before --watch updates "
+                        "the output.")
+    parser.add_argument('--poll', type=float, default=None,
+                        help="Poll for changes every this many seconds, "
+                        "instead of using inotify (needs pyinotify).")
+    parser.add_argument('--ignore', nargs='*', default=[],
+                        help="Extra glob patterns of paths to skip, in "
+                        "addition to %s." % (', '.join(DEFAULT_IGNORE)))
+    parser.add_argument('--cache', default=None,
+                        help="Parsed tag cache file. "
+                        "Default: <root>/.repo/tagdoc_cache.sqlite")
+    parser.add_argument('--cache_size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help="Max size of parsed tag cache, in MB.")
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help="Do not use parsed tag cache.")
+
+    parser.add_argument('--trace', default=None,
+                        help="Write a Chrome trace to this file, and log a "
+                        "timing summary.")
 
     return parser
 
@@ -273,14 +1892,27 @@ def main():
     for attr in ['root', 'out']:
         setattr(args, attr, os.path.abspath(getattr(args, attr)))
 
+    if args.trace is not None:
+        utils.enable_trace()
+
+    if args.ref is not None and args.incremental:
+        parser.error("--incremental works on the checkout, not with --ref.")
+    if args.watch and (args.ref is not None or args.validate):
+        parser.error("--watch works on the checkout, and writes output.")
+
     if not os.path.isdir(os.path.join(args.root, '.repo')):
         logger.error("No .repo dir found under %s" % (args.root))
         return
 
     release_branch_prefix = 'phonelab/%s/release-' % (args.aosp)
-    develop_branch = 'phonelab/%s/develop' % (args.aosp)
+    develop_branch = args.develop or 'phonelab/%s/develop' % (args.aosp)
+
+    projects = RepoProject.load_all(args.root)
+    if args.ref is not None:
+        # Document the requested ref instead of the checked out branch.
+        for proj in projects:
+            proj.current_branch = args.ref
 
-    projects = RepoProject.create_from_dir(args.root)
     for proj in projects:
         if not proj.current_branch.startswith(release_branch_prefix):
             logger.error("Project %s not in release branch, current branch is %s."
@@ -293,25 +1925,83 @@ def main():
             "Not all projects in same branch, do a `repo status` and check.")
         # return
 
-    cwd = os.getcwd()
-    tag_docs = []
-    for proj in projects:
-        os.chdir(proj.abs_path)
-        ret = subprocess.call('git diff %s --exit-code 2>&1 >/dev/null' %
-                              (develop_branch), shell=True)
-        if ret == 0:
-            logger.debug("Ignoring repo %s: not changes" % (proj))
-            continue
-
-        logger.info("Parsing project %s" % (proj.path))
-        new_tags = TagDoc.create_from_proj(proj)
-        logger.info("%d tags found." % (len(new_tags)))
-        tag_docs.extend(new_tags)
-
-    os.chdir(cwd)
-
-    with open(args.out, 'w') as f:
-        print >>f, str(FORMATTER_MAPPING[args.format](tag_docs))
+    with utils.span('find_changed_projects'):
+        changed_projects = find_changed_projects(projects, develop_branch,
+                                                 ref=args.ref)
+
+    cache = None
+    if not args.no_cache:
+        cache = TagCache(args.cache or
+                         os.path.join(args.root, '.repo', 'tagdoc_cache.sqlite'),
+                         max_bytes=args.cache_size * 1024 * 1024)
+
+    walker = SourceWalker(args.root, [proj.path for proj in projects],
+                          ignore=DEFAULT_IGNORE + args.ignore)
+
+    try:
+        if args.watch:
+            watcher = TagWatcher(args.root, projects, develop_branch, walker,
+                                 args.out, args.format, cache=cache,
+                                 jobs=args.jobs, debounce=args.debounce,
+                                 poll_interval=args.poll)
+            watcher.load(changed_projects)
+            watcher.write()
+            logger.info("Wrote %s." % (args.out))
+            # Stop cleanly when the service manager stops us.
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+            return
+        elif args.validate:
+            with utils.span('validate'):
+                problems = validate(projects, changed_projects,
+                                    develop_branch, ref=args.ref,
+                                    jobs=args.jobs, cache=cache,
+                                    walker=walker)
+        elif args.ref is not None:
+            with utils.span('create_from_ref'):
+                tag_docs = TagDoc.create_from_ref(changed_projects, args.ref,
+                                                  jobs=args.jobs, cache=cache)
+        elif args.incremental:
+            index = TagIndex(args.index or os.path.join(
+                args.root, '.repo', 'tagdoc_index.json'))
+            with utils.span('create_incremental'):
+                tag_docs = TagDoc.create_incremental(
+                    changed_projects, develop_branch, index, jobs=args.jobs,
+                    cache=cache, walker=walker)
+            index.save()
+        else:
+            with utils.span('create_from_projs'):
+                tag_docs = TagDoc.create_from_projs(changed_projects,
+                                                    jobs=args.jobs,
+                                                    cache=cache,
+                                                    walker=walker)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if args.validate:
+        for src_file, line_no, reason in problems:
+            logger.error("%s:%d: %s" % (os.path.relpath(src_file, args.root),
+                                        line_no, reason))
+        logger.info("%d tag doc problems in %d changed projects." %
+                    (len(problems), len(changed_projects)))
+        if args.trace is not None:
+            utils.trace_summary()
+            utils.write_trace(args.trace)
+        sys.exit(1 if len(problems) > 0 else 0)
+
+    if args.ref is None:
+        walker.report()
+
+    with open(args.out, 'wb') as f, utils.span('format'):
+        FORMATTER_MAPPING[args.format](tag_docs).write(f)
+
+    if args.trace is not None:
+        utils.trace_summary()
+        utils.write_trace(args.trace)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,16 @@
 import os
+import collections
+import functools
 import subprocess
 import logging
 import hashlib
+import json
+import select
+import signal
+import sys
+import threading
 import time
-import xml.etree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
 
 logging.basicConfig(format='[%(asctime)s] %(levelname)8s [%(filename)16s:%(lineno)4d] %(message)s', level=logging.DEBUG)
 logger = logging.getLogger('phonelab')
@@ -11,20 +18,328 @@ logger = logging.getLogger('phonelab')
 
 DEVNULL = open(os.devnull, 'w')
 
-def call(cmd, verbose=False, dryrun=False):
+DEFAULT_TAIL_KB = 16
+"""Output kept per command to show when it fails, in KB."""
+
+_running = set()
+_running_lock = threading.Lock()
+
+
+class RingBuffer(object):
+  """Keeps the last ``max_bytes`` bytes written to it.
+
+  Args:
+      max_bytes (int): capacity, ``None`` to keep everything.
+  """
+
+  def __init__(self, max_bytes=None):
+    self.max_bytes = max_bytes
+    self._chunks = collections.deque()
+    self._size = 0
+    self.dropped = 0
+
+  def write(self, data):
+    self._chunks.append(data)
+    self._size += len(data)
+    if self.max_bytes is None:
+      return
+    while self._chunks and \
+        self._size - len(self._chunks[0]) >= self.max_bytes:
+      chunk = self._chunks.popleft()
+      self._size -= len(chunk)
+      self.dropped += len(chunk)
+
+  def getvalue(self):
+    data = b''.join(self._chunks)
+    if self.max_bytes is not None and len(data) > self.max_bytes:
+      self.dropped += len(data) - self.max_bytes
+      data = data[-self.max_bytes:]
+    self._chunks = collections.deque([data])
+    self._size = len(data)
+    return data
+
+
+class CommandResult(object):
+  """Outcome of a command run by :func:`run`.
+
+  Attributes:
+      cmd (str or list): the command.
+      cwd (str): dir the command ran in.
+      returncode (int): exit code, negative if killed by a signal.
+      duration (float): wall time in seconds.
+      output (str): standard output, see ``max_output`` of :func:`run`.
+      tail (str): last bytes of standard output and error, interleaved.
+  """
+
+  def __init__(self, cmd, cwd, returncode, duration, output, tail):
+    self.cmd = cmd
+    self.cwd = cwd
+    self.returncode = returncode
+    self.duration = duration
+    self.output = output
+    self.tail = tail
+
+  @property
+  def ok(self):
+    return self.returncode == 0
+
+  def check(self):
+    """Raise :class:`CommandError` if the command failed.
+
+    Returns:
+        CommandResult: this result, for chaining.
+    """
+    if self.returncode != 0:
+      raise CommandError(self)
+    return self
+
+
+class CommandError(subprocess.CalledProcessError):
+  """A command exited with non-zero code.
+
+  Attributes:
+      result (CommandResult): the failed command, with the tail of its
+          output.
+  """
+
+  def __init__(self, result):
+    cmd = ' '.join(result.cmd) if isinstance(result.cmd, (list, tuple)) \
+        else result.cmd
+    subprocess.CalledProcessError.__init__(self, result.returncode, cmd,
+                                           result.output)
+    self.result = result
+
+  def __str__(self):
+    return "Command '%s' in %s returned non-zero exit status %d after " \
+        "%.1f sec" % (self.cmd, self.result.cwd, self.returncode,
+                      self.result.duration)
+
+
+def run(cmd, cwd=None, env=None, verbose=False, max_output=None,
+        tail_kb=DEFAULT_TAIL_KB, new_group=False, log=None, on_line=None):
+  """Run a command and capture its output.
+
+  Standard output and error are read as they are produced, so memory stays
+  bounded for chatty commands: only ``max_output`` bytes of standard output
+  and the last ``tail_kb`` KB of both streams are kept.
+
+  Args:
+      cmd (str or list): shell command, or argument list run without a
+          shell.
+      cwd (str): dir to run in, defaults to the current dir.
+      env (dict): environment, defaults to the current one.
+      verbose (bool): log the command and echo its output.
+      max_output (int): bytes of standard output to keep (the last ones),
+          ``None`` to keep all.
+      tail_kb (int): KB of combined output to keep for diagnosis.
+      new_group (bool): see :func:`call`.
+      log (file): file to copy standard output and error to, as they are
+          read.
+      on_line (callable): called with each complete line of standard output
+          or error, without the newline. If it returns ``True`` the command
+          is terminated, and its remaining output is still read.
+
+  Returns:
+      CommandResult: exit code, duration and output. Failure is not an error
+      here, see :meth:`CommandResult.check`.
+  """
+  cwd = cwd or os.getcwd()
+  shell = not isinstance(cmd, (list, tuple))
   if verbose:
-    logger.debug(cmd)
-    if not dryrun:
-      subprocess.check_call(cmd, shell=True)
-  else:
-    if not dryrun:
-      subprocess.check_call(cmd, stdout=DEVNULL, stderr=DEVNULL, shell=True)
+    logger.debug('(%s) %s' % (cwd, cmd if shell else ' '.join(cmd)))
+
+  output = RingBuffer(max_output)
+  tail = RingBuffer(tail_kb * 1024)
+  start = time.time()
+  with span(command_name(cmd), cmd=cmd, cwd=cwd):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, shell=shell, cwd=cwd,
+                            env=env, close_fds=True,
+                            preexec_fn=os.setpgrp if new_group else None)
+    with _running_lock:
+      _running.add((proc, new_group))
+    try:
+      streams = {proc.stdout.fileno(): output, proc.stderr.fileno(): None}
+      partial = dict((fd, '') for fd in streams)
+      stopped = False
+      while streams:
+        ready = select.select(list(streams), [], [])[0]
+        for fd in ready:
+          data = os.read(fd, 65536)
+          if not data:
+            del streams[fd]
+            lines = [partial.pop(fd)] if partial[fd] else []
+          else:
+            if streams[fd] is not None:
+              streams[fd].write(data)
+            tail.write(data)
+            if log is not None:
+              log.write(data)
+            if verbose:
+              sys.stdout.write(data)
+            if on_line is None:
+              continue
+            lines = (partial[fd] + data).split('\n')
+            partial[fd] = lines.pop()
+          for line in lines:
+            if on_line(line) and not stopped:
+              stopped = True
+              _kill(proc, new_group)
+      returncode = proc.wait()
+    finally:
+      proc.stdout.close()
+      proc.stderr.close()
+      with _running_lock:
+        _running.discard((proc, new_group))
+  if verbose:
+    sys.stdout.flush()
+
+  return CommandResult(cmd, cwd, returncode, time.time() - start,
+                       output.getvalue(), tail.getvalue())
+
+
+class Runner(object):
+  """Runs commands concurrently, at most ``jobs`` at a time.
+
+  Example::
+
+      runner = utils.Runner(8)
+      try:
+          results = runner.map(lambda p: runner.run('git fetch', cwd=p),
+                               paths)
+      finally:
+          runner.close()
+
+  Args:
+      jobs (int): max number of commands running at the same time.
+  """
+
+  def __init__(self, jobs):
+    self.jobs = max(1, jobs)
+    self._slots = threading.BoundedSemaphore(self.jobs)
+    self._pool = None
+    self._pool_lock = threading.Lock()
+
+  def run(self, cmd, **kwargs):
+    """:func:`run` a command once a slot is free."""
+    with self._slots:
+      return run(cmd, **kwargs)
+
+  def map(self, func, items):
+    """Order-preserving ``map`` of ``func`` over ``jobs`` threads.
+
+    ``func`` should use :meth:`run` for its commands, so that the limit holds
+    when it is also used elsewhere.
+    """
+    if len(items) == 0:
+      return []
+    parent = current_span()
+
+    def traced(item):
+      # Nest spans of the pool threads under the caller's span.
+      _span_stack().append(parent)
+      try:
+        return func(item)
+      finally:
+        _span_stack().pop()
+
+    if parent is None:
+      return self._get_pool().map(func, items)
+    return self._get_pool().map(traced, items)
+
+  def _get_pool(self):
+    with self._pool_lock:
+      if self._pool is None:
+        self._pool = ThreadPool(self.jobs)
+      return self._pool
+
+  def close(self):
+    """Stop the threads of :meth:`map`."""
+    with self._pool_lock:
+      pool, self._pool = self._pool, None
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+
+def call(cmd, verbose=False, dryrun=False, cwd=None, env=None,
+         new_group=False):
+  """Run a shell command, raise ``CalledProcessError`` if it fails.
+
+  The tail of the command's output is logged when it fails, see
+  :func:`run`.
+
+  Args:
+      new_group (bool): run the command in its own process group, so that
+          :func:`kill_running` can stop it along with all its children. Such
+          commands do not get terminal signals (e.g. Ctrl-C) and can not read
+          from the terminal.
+
+  Throws:
+    CommandError: if the command fails.
+  """
+  if dryrun:
+    if verbose:
+      logger.debug(cmd if cwd is None else '(%s) %s' % (cwd, cmd))
+    return
+
+  result = run(cmd, cwd=cwd, env=env, verbose=verbose, max_output=0,
+               new_group=new_group)
+  if not result.ok and not verbose and result.tail:
+    logger.error("'%s' failed (%d), last output:\n%s" %
+                 (cmd, result.returncode, result.tail.rstrip()))
+  result.check()
+
+
+def reraise(exc_info):
+  """Raise ``sys.exc_info()`` saved elsewhere, e.g. in another thread.
+
+  The original traceback is kept, instead of one starting at the
+  ``raise``.
+  """
+  # ``raise t, v, tb`` is Python 2 only syntax, keep the module compiling
+  # under Python 3 tools.
+  exec('raise exc_info[0], exc_info[1], exc_info[2]')
+
+
+def kill_running():
+  """Terminate all commands started by :func:`run` that are still running.
+  """
+  with _running_lock:
+    running = list(_running)
+  for proc, new_group in running:
+    _kill(proc, new_group)
+
+
+def _kill(proc, new_group):
+  """Terminate a command, with its whole process group if it has one."""
+  try:
+    if new_group:
+      os.killpg(proc.pid, signal.SIGTERM)
+    else:
+      proc.terminate()
+  except OSError:
+    pass
+
 
+def command_name(cmd):
+  """Short name of a shell command for traces, e.g. ``git merge``.
 
-def repo_forall(cmd, verbose=False, dryrun=False):
+  Leading environment assignments are skipped.
+  """
+  words = list(cmd) if isinstance(cmd, (list, tuple)) else cmd.split()
+  words = [w for w in words if '=' not in w or w.startswith('-')]
+  if len(words) > 1 and words[0] in ('git', 'repo', 'python'):
+    return '%s %s' % (words[0], os.path.basename(words[1]))
+  return words[0] if words else cmd
+
+
+def repo_forall(cmd, verbose=False, dryrun=False, jobs=4):
   """Wrap of ``repo forall`` without output pager.
   """
-  call('GIT_PAGER= repo forall -j 4 -epv -c %s' % (cmd), verbose, dryrun)
+  with span('repo_forall', cmd=cmd, jobs=jobs):
+    call('GIT_PAGER= repo forall -j %d -epv -c %s' % (jobs, cmd), verbose,
+         dryrun)
 
 
 def bump_version(ver):
@@ -65,25 +380,191 @@ def find(dir, filename):
   return hit
 
 
+class Span(object):
+  """A timed region of a trace, see :func:`span`.
+
+  Attributes:
+      name (str): span name, used to group spans in the summary.
+      path (str): names of the enclosing spans and this one, ``/`` separated.
+      args (dict): extra details shown in the trace viewer.
+      start (float): start time, as returned by ``time.time()``.
+      duration (float): duration in seconds, ``None`` while running.
+  """
+
+  def __init__(self, name, parent=None, **args):
+    self.name = name
+    self.parent = parent if parent is not None else current_span()
+    self.path = name if self.parent is None else \
+        '%s/%s' % (self.parent.path, name)
+    self.args = args
+    self.start = None
+    self.duration = None
+    self.tid = None
+
+  def __enter__(self):
+    self.tid = threading.current_thread().ident
+    _span_stack().append(self)
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.duration = time.time() - self.start
+    _span_stack().pop()
+    with _trace_lock:
+      if _trace is not None:
+        _trace.append(self)
+    return False
+
+
+class _NullSpan(object):
+
+  def __enter__(self):
+    return None
+
+  def __exit__(self, *exc_info):
+    return False
+
+
+_NULL_SPAN = _NullSpan()
+_trace = None
+_trace_lock = threading.Lock()
+_trace_local = threading.local()
+
+
+def _span_stack():
+  if not hasattr(_trace_local, 'stack'):
+    _trace_local.stack = []
+  return _trace_local.stack
+
+
+def enable_trace():
+  """Start recording spans, see :func:`span`.
+  """
+  global _trace
+  with _trace_lock:
+    if _trace is None:
+      _trace = []
+
+
+def current_span():
+  """Innermost running span of this thread, or ``None``.
+
+  Pass it as ``parent`` to spans of worker threads, so that they are nested
+  under the span that started the work.
+  """
+  stack = getattr(_trace_local, 'stack', None)
+  return stack[-1] if stack else None
+
+
+def span(name, parent=None, **args):
+  """Time a region of code as a trace span.
+
+  Spans nest: a span started while another one is running in the same
+  thread, or with an explicit ``parent``, is its child. Nothing is recorded
+  unless :func:`enable_trace` was called.
+
+  Example::
+
+      with utils.span('merge_project', proj=path):
+          ...
+
+  Args:
+      name (str): span name.
+      parent (Span): parent span, defaults to :func:`current_span`.
+      args: extra details shown in the trace viewer.
+
+  Returns:
+      Span: context manager of the span.
+  """
+  if _trace is None:
+    return _NULL_SPAN
+  return Span(name, parent, **args)
+
+
+def add_span(name, start, duration, parent=None, tid=None, **args):
+  """Record a span timed elsewhere, e.g. by a worker process.
+
+  Args:
+      name (str): span name.
+      start (float): start time, as returned by ``time.time()``.
+      duration (float): duration in seconds.
+      parent (Span): parent span, defaults to :func:`current_span`.
+      tid (int): trace viewer row, defaults to the current thread.
+      args: extra details shown in the trace viewer.
+
+  Returns:
+      Span: the recorded span, or ``None`` if tracing is off.
+  """
+  if _trace is None:
+    return None
+  s = Span(name, parent, **args)
+  s.start = start
+  s.duration = duration
+  s.tid = tid if tid is not None else threading.current_thread().ident
+  with _trace_lock:
+    _trace.append(s)
+  return s
+
+
+def write_trace(path):
+  """Write recorded spans in Chrome trace format.
+
+  The file can be loaded in ``chrome://tracing`` or Perfetto.
+
+  Args:
+      path (str): output file.
+  """
+  with _trace_lock:
+    spans = list(_trace or [])
+  pid = os.getpid()
+  events = []
+  for s in spans:
+    args = dict((k, str(v)) for k, v in s.args.items())
+    args['path'] = s.path
+    events.append({'name': s.name, 'cat': s.path.split('/')[0], 'ph': 'X',
+                   'ts': int(s.start * 1e6), 'dur': int(s.duration * 1e6),
+                   'pid': pid, 'tid': s.tid, 'args': args})
+  with open(path, 'w') as f:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def trace_summary():
+  """Log count, total, mean and max duration of recorded spans.
+
+  Spans are grouped by path, so the same name under different parents is
+  reported separately, and children are listed under their parents.
+  """
+  with _trace_lock:
+    spans = list(_trace or [])
+  if len(spans) == 0:
+    return
+
+  stats = {}
+  for s in spans:
+    count, total, longest = stats.get(s.path, (0, 0.0, 0.0))
+    stats[s.path] = (count + 1, total + s.duration, max(longest, s.duration))
+
+  logger.info("%-50s %6s %10s %10s %10s" %
+              ('span', 'count', 'total', 'mean', 'max'))
+  for path in sorted(stats, key=lambda p: p.split('/')):
+    count, total, longest = stats[path]
+    name = '  ' * path.count('/') + path.split('/')[-1]
+    logger.info("%-50s %6d %9.2fs %9.2fs %9.2fs" %
+                (name[:50], count, total, total / count, longest))
+
+
 def time_it(func):
+  """Decorator that logs how long ``func`` takes and records it as a span.
+  """
 
+  @functools.wraps(func)
   def func_wrapper(*args, **kwargs):
     start = time.time()
-    func(*args, **kwargs)
+    with span(func.__name__):
+      result = func(*args, **kwargs)
     duration_sec = time.time() - start
     logger.debug("%s finished, time elapesd: %d min %d sec" % (func.__name__,\
         int(duration_sec / 60), int(duration_sec % 60)))
+    return result
 
   return func_wrapper
-
-
-def get_repo_projs(aosp_root):
-    projs = []
-    for child in ET.parse(os.path.join(aosp_root, '.repo', 'manifests',\
-        'default.xml')).getroot():
-      if child.tag == 'project' and 'notdefault' not in child.attrib.get(\
-          'groups', ''):
-        projs.append(child.attrib['path'])
-
-    return projs
-